@@ -0,0 +1,141 @@
+"""
+节点和订阅接口的异步版本，只在 ASGI 下启用 (apps/asgi.py)
+
+数据库查询用 django 的异步 ORM
+NOTE redis 客户端在 3.5.3 没有 asyncio 版本，redis 和比较重的同步逻辑放到
+sync_to_async 里跑，不会卡住事件循环
+节点拉配置支持长轮询，配置没变时挂起请求，版本号变动后马上返回
+"""
+
+import asyncio
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from apps.api import views
+from apps.ext import version_watcher
+from apps.proxy import models as m
+from apps.sspanel.models import User
+from apps.utils import check_api_token, parse_json_request
+
+# NOTE django 4.2 的 method_decorator 不支持异步的 view，鉴权和解析 json
+# 直接调 apps.utils 里装饰器用的同一套函数
+
+
+def _get_wait_seconds(request):
+    try:
+        wait = int(request.GET.get("wait", 0))
+    except ValueError:
+        return 0
+    return max(0, min(wait, settings.CONFIG_LONG_POLL_TIMEOUT))
+
+
+async def _long_poll(request, keys, get_version):
+    """
+    长轮询: 请求带上 If-None-Match 和 wait 参数时，配置没变就挂起等待，
+    直到版本号有变动或者超时，超时返回 304
+
+    返回 (etag, response)，response 不是 None 的时候直接返回给节点
+    """
+    wait = _get_wait_seconds(request)
+    async with version_watcher.watch(keys if wait else []) as changed:
+        etag = quote_etag(await sync_to_async(get_version)())
+        response = get_conditional_response(request, etag=etag)
+        if response is None or not wait:
+            return etag, response
+        await asyncio.wait([changed], timeout=wait)
+    etag = quote_etag(await sync_to_async(get_version)())
+    return etag, get_conditional_response(request, etag=etag)
+
+
+class AsyncUserNodeMixin:
+    async def get(self, request):
+        if response := self.check_uid(request):
+            return response
+        uid = str(uuid.UUID(request.GET["uid"]))
+        user_id = await sync_to_async(User.get_id_by_uid)(uid)
+        user = await User.objects.filter(id=user_id).afirst() if user_id else None
+        if not user:
+            return HttpResponseBadRequest("user not found")
+        return await sync_to_async(self.get_user_response)(request, user)
+
+
+class SubscribeView(AsyncUserNodeMixin, views.SubscribeView):
+    pass
+
+
+class ClashProxyProviderView(AsyncUserNodeMixin, views.ClashProxyProviderView):
+    pass
+
+
+class ClashDirectDomainRuleSetView(
+    AsyncUserNodeMixin, views.ClashDirectDomainRuleSetView
+):
+    pass
+
+
+class ClashDirectIPRuleSetView(AsyncUserNodeMixin, views.ClashDirectIPRuleSetView):
+    pass
+
+
+class ProxyConfigsView(views.ProxyConfigsView):
+    async def get(self, request, node_id):
+        if response := check_api_token(request):
+            return response
+        etag, response = await _long_poll(
+            request,
+            m.ProxyNode.get_config_version_keys(node_id),
+            lambda: m.ProxyNode.get_config_version(node_id),
+        )
+        if response:
+            return response
+        snapshot = await sync_to_async(m.ProxyNode.get_proxy_configs_snapshot)(
+            node_id, request.GET.get("since")
+        )
+        if snapshot is None:
+            return HttpResponseBadRequest()
+        response = HttpResponse(snapshot, content_type="application/json")
+        response["ETag"] = etag
+        return response
+
+    async def post(self, request, node_id):
+        if response := parse_json_request(request) or check_api_token(request):
+            return response
+        node = await m.ProxyNode.objects.filter(pk=node_id).afirst()
+        if not node:
+            return HttpResponseBadRequest()
+        await sync_to_async(self.report_traffic)(node, request.json)
+        return JsonResponse(data={})
+
+
+class EhcoRelayConfigView(views.EhcoRelayConfigView):
+    async def get(self, request, node_id):
+        if response := check_api_token(request):
+            return response
+        etag, response = await _long_poll(
+            request,
+            m.RelayNode.get_config_version_keys(node_id),
+            lambda: m.RelayNode.get_config_version(node_id),
+        )
+        if response:
+            return response
+        snapshot = await sync_to_async(m.RelayNode.get_config_snapshot)(node_id)
+        if snapshot is None:
+            return HttpResponseBadRequest()
+        response = HttpResponse(snapshot, content_type="application/json")
+        response["ETag"] = etag
+        return response
+
+    async def post(self, request, node_id):
+        if response := parse_json_request(request) or check_api_token(request):
+            return response
+        node = await m.RelayNode.objects.filter(pk=node_id).afirst()
+        if not node:
+            return HttpResponseBadRequest()
+        if request.json:
+            await sync_to_async(self.report_traffic)(node, request.json)
+        return JsonResponse(data={})
@@ -1,25 +1,29 @@
+from django.conf import settings
 from django.urls import path
 
-from . import views
+from . import async_views, views
+
+# NOTE 节点和订阅接口在 ASGI 下使用异步的版本
+agent_views = async_views if settings.ASYNC_VIEWS_ENABLED else views
 
 app_name = "api"
 urlpatterns = [
     path("system_status/", views.SystemStatusView.as_view(), name="system_status"),
     path("user/settings/", views.UserSettingsView.as_view(), name="user_settings"),
-    path("subscribe/", views.SubscribeView.as_view(), name="subscribe"),
+    path("subscribe/", agent_views.SubscribeView.as_view(), name="subscribe"),
     path(
         "subscribe/clash/proxy_providers/",
-        views.ClashProxyProviderView.as_view(),
+        agent_views.ClashProxyProviderView.as_view(),
         name="proxy_providers",
     ),
     path(
         "subscribe/clash/direct_domain_rule_set/",
-        views.ClashDirectDomainRuleSetView.as_view(),
+        agent_views.ClashDirectDomainRuleSetView.as_view(),
         name="direct_domain_rule_set",
     ),
     path(
         "subscribe/clash/direct_ip_rule_set/",
-        views.ClashDirectIPRuleSetView.as_view(),
+        agent_views.ClashDirectIPRuleSetView.as_view(),
         name="direct_domain_rule_set",
     ),
     path("shop/", views.purchase, name="purchase"),
@@ -29,12 +33,12 @@ urlpatterns = [
     # web api 接口
     path(
         "proxy_configs/<int:node_id>/",
-        views.ProxyConfigsView.as_view(),
+        agent_views.ProxyConfigsView.as_view(),
         name="proxy_configs",
     ),
     path(
         "ehco_relay_config/<int:node_id>/",
-        views.EhcoRelayConfigView.as_view(),
+        agent_views.EhcoRelayConfigView.as_view(),
         name="ehco_relay_config",
     ),
     # 支付
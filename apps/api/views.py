@@ -1,18 +1,24 @@
+import abc
+import hashlib
+import time
 import uuid
-from typing import List
 
 import pendulum
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
 from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition, require_http_methods
 
-from apps.ext import lock
+from apps import constants as c
+from apps.ext import cache, lock, presence
 from apps.proxy import models as m
+from apps.proxy.traffic import traffic_buffer
 from apps.sspanel import tasks
 from apps.sspanel.models import Goods, User, UserCheckInLog, UserOrder
 from apps.sub import UserSubManager
@@ -23,7 +29,6 @@ from apps.utils import (
     get_client_ip,
     get_current_datetime,
     handle_json_request,
-    is_ip_address,
     traffic_format,
 )
 
@@ -65,116 +70,144 @@ class UserSettingsView(View):
         return JsonResponse(data)
 
 
-class UserNodeBaseView(View):
-    def get_user_and_nodes(self, request):
+class UserNodeBaseView(abc.ABC, View):
+    # NOTE 会影响订阅内容的请求参数
+    CACHE_PARAMS = ("client", "protocol", "native_ip")
+
+    def check_uid(self, request):
         if uid := request.GET.get("uid"):
             try:
                 uuid.UUID(uid)
             except ValueError:
-                return None, HttpResponseBadRequest("invalid uid")
+                return HttpResponseBadRequest("invalid uid")
         else:
-            return None, HttpResponseBadRequest("uid is required")
+            return HttpResponseBadRequest("uid is required")
 
-        user = User.objects.filter(uid=uid).first()
+    def get_user(self, request):
+        if response := self.check_uid(request):
+            return None, response
+        user_id = User.get_id_by_uid(str(uuid.UUID(request.GET["uid"])))
+        user = User.objects.filter(id=user_id).first() if user_id else None
         if not user:
             return None, HttpResponseBadRequest("user not found")
+        return user, None
 
-        node_list = m.ProxyNode.get_user_active_nodes(user)
-        native_ip = request.GET.get("native_ip")
-        if native_ip:
-            node_list = node_list.filter(native_ip=True)
-        if node_list.count() == 0:
-            return None, HttpResponseBadRequest("no active nodes for you")
+    def get(self, request):
+        user, response = self.get_user(request)
+        if response:
+            return response
+        return self.get_user_response(request, user)
+
+    def get_user_response(self, request, user):
+        """按请求参数缓存 render_nodes 生成的内容"""
+        return self.get_cached_response(
+            request, user, lambda: self.gen_nodes_response(request, user)
+        )
 
-        return user, node_list
+    def gen_nodes_response(self, request, user):
+        response_or_nodes = self.get_nodes(request, user)
+        if isinstance(response_or_nodes, HttpResponse):
+            return response_or_nodes
+        return self.render_nodes(request, user, response_or_nodes)
+
+    @abc.abstractmethod
+    def render_nodes(self, request, user, nodes):
+        """用用户能看到的节点 id 生成响应"""
+
+    def get_nodes(self, request, user):
+        """返回用户能看到的节点 id，没有可用节点时返回 400"""
+        nodes = m.ProxyNode.get_user_visible_nodes(user)
+        if request.GET.get("native_ip"):
+            nodes = [n for n in nodes if n["native_ip"]]
+        if not nodes:
+            return HttpResponseBadRequest("no active nodes for you")
+        if protocol := request.GET.get("protocol"):
+            if protocol in m.ProxyNode.NODE_TYPE_SET:
+                nodes = [n for n in nodes if n["node_type"] == protocol]
+        return [n["id"] for n in nodes]
+
+    def get_cached_response(self, request, user, gen_response):
+        """
+        订阅内容缓存起来，客户端带着 ETag/Last-Modified 来的时候内容没变就返回 304
+        gen_response 只有缓存没命中的时候才会调用，非 200 的结果不缓存
+        """
+        key = UserSubManager.get_cache_key(
+            user,
+            self.__class__.__name__,
+            *[request.GET.get(p) for p in self.CACHE_PARAMS],
+        )
+        cached = cache.get(key)
+        if cached is None:
+            response = gen_response()
+            if response.status_code != 200:
+                return response
+            cached = {
+                "content": response.content.decode(),
+                "content_type": response["Content-Type"],
+                "etag": f'"{hashlib.md5(response.content).hexdigest()}"',
+                "last_modified": int(time.time()),
+            }
+            cache.set(key, cached, ttl=c.CACHE_TTL_DAY)
+        response = HttpResponse(cached["content"], content_type=cached["content_type"])
+        response["ETag"] = cached["etag"]
+        response["Last-Modified"] = http_date(cached["last_modified"])
+        return get_conditional_response(
+            request,
+            etag=cached["etag"],
+            last_modified=cached["last_modified"],
+            response=response,
+        )
 
 
 class SubscribeView(UserNodeBaseView):
-    def get(self, request):
-        user, response_or_nodes = self.get_user_and_nodes(request)
-        if not isinstance(response_or_nodes, HttpResponse):
-            node_list = response_or_nodes
-
-            if protocol := request.GET.get("protocol"):
-                if protocol in m.ProxyNode.NODE_TYPE_SET:
-                    node_list = node_list.filter(node_type=protocol)
-
-            sub_client = request.GET.get("client")
-            try:
-                sub_info = UserSubManager(user, node_list, sub_client).get_sub_info()
-            except ValueError as e:
-                return HttpResponseBadRequest(str(e))
-            return HttpResponse(
-                sub_info,
-                content_type="text/plain; charset=utf-8",
-                headers=user.get_sub_info_header(
-                    for_android=sub_client != UserSubManager.CLIENT_SHADOWROCKET
-                ),
-            )
-        else:
-            return response_or_nodes
+    def get_user_response(self, request, user):
+        response = super().get_user_response(request, user)
+        sub_client = request.GET.get("client")
+        if response.status_code in (200, 304):
+            # NOTE 流量信息每次都要是最新的，不能缓存
+            for k, v in user.get_sub_info_header(
+                for_android=sub_client != UserSubManager.CLIENT_SHADOWROCKET
+            ).items():
+                response[k] = v
+        return response
+
+    def render_nodes(self, request, user, nodes):
+        sub_client = request.GET.get("client")
+        try:
+            sub_info = UserSubManager(user, nodes, sub_client).get_sub_info()
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        return HttpResponse(sub_info, content_type="text/plain; charset=utf-8")
 
 
 class ClashProxyProviderView(UserNodeBaseView):
-    def get(self, request):
-        user, response_or_nodes = self.get_user_and_nodes(request)
-        if not isinstance(response_or_nodes, HttpResponse):
-            node_list = response_or_nodes
-            providers = UserSubManager(user, node_list).get_clash_proxy_providers()
-            return HttpResponse(
-                providers,
-                content_type="text/plain; charset=utf-8",
-            )
-        else:
-            return response_or_nodes
+    def render_nodes(self, request, user, nodes):
+        providers = UserSubManager(user, nodes).get_clash_proxy_providers()
+        return HttpResponse(providers, content_type="text/plain; charset=utf-8")
 
 
 class ClashDirectRuleSetBaseView(UserNodeBaseView):
-    def get_rule_set(self, node_list, is_ip: bool):
-        rule_set = set()
-        for node in node_list:
-            if node.enable_relay:
-                for rule in node.get_enabled_relay_rules():
-                    if is_ip == is_ip_address(rule.relay_host):
-                        rule_set.add(rule.relay_host)
-            if node.enable_direct:
-                if is_ip == is_ip_address(node.server):
-                    rule_set.add(node.server)
-        return sorted(rule_set)
+    template_name = ""
+    is_ip = False
+
+    def render_nodes(self, request, user, nodes):
+        rule_set = UserSubManager(user, nodes).get_rule_set(self.is_ip)
+        return render(
+            request,
+            self.template_name,
+            context={"ip_list" if self.is_ip else "domain_list": rule_set},
+            content_type="text/plain; charset=utf-8",
+        )
 
 
 class ClashDirectDomainRuleSetView(ClashDirectRuleSetBaseView):
-    def get(self, request):
-        _, response_or_nodes = self.get_user_and_nodes(request)
-        if not isinstance(response_or_nodes, HttpResponse):
-            node_list = response_or_nodes
-            domain_list = self.get_rule_set(node_list, is_ip=False)
-            context = {"domain_list": domain_list}
-            return render(
-                request,
-                "clash/direct_domain.yaml",
-                context=context,
-                content_type="text/plain; charset=utf-8",
-            )
-        else:
-            return response_or_nodes
+    template_name = "clash/direct_domain.yaml"
+    is_ip = False
 
 
 class ClashDirectIPRuleSetView(ClashDirectRuleSetBaseView):
-    def get(self, request):
-        _, response_or_nodes = self.get_user_and_nodes(request)
-        if not isinstance(response_or_nodes, HttpResponse):
-            node_list = response_or_nodes
-            ip_list = self.get_rule_set(node_list, is_ip=True)
-            context = {"ip_list": ip_list}
-            return render(
-                request,
-                "clash/direct_ip.yaml",
-                context=context,
-                content_type="text/plain; charset=utf-8",
-            )
-        else:
-            return response_or_nodes
+    template_name = "clash/direct_ip.yaml"
+    is_ip = True
 
 
 class UserRefChartView(View):
@@ -189,12 +222,57 @@ class UserRefChartView(View):
 
 
 class UserTrafficChartView(View):
+    """
+    参数 granularity: day/hour，start/end: 时间范围
+    默认是最近 7 天/24 小时
+    """
+
+    # NOTE 一次最多能查的时间点数量
+    MAX_BUCKETS = 24 * 31
+
+    @staticmethod
+    def parse_datetime(value):
+        """只接受时间点，P1D 这种 pendulum 会解析成时长/时间段的也算非法"""
+        try:
+            dt = pendulum.parse(value, tz=get_current_datetime().timezone)
+        except TypeError:
+            # NOTE 2024-01-01/P1D 这种时间段 pendulum 自己会抛 TypeError
+            raise ValueError(f"not a datetime: {value}")
+        if not isinstance(dt, pendulum.DateTime):
+            raise ValueError(f"not a datetime: {value}")
+        return dt
+
+    def get_window(self, request, granularity):
+        end = request.GET.get("end")
+        end = self.parse_datetime(end) if end else get_current_datetime()
+        start = request.GET.get("start")
+        if start:
+            start = self.parse_datetime(start)
+        elif granularity == m.UserTrafficLog.GRANULARITY_HOUR:
+            start = end.subtract(hours=23)
+        else:
+            start = end.subtract(days=6)
+        return start, end
+
     @method_decorator(login_required)
     def get(self, request):
         node_id = request.GET.get("node_id", 0)
         user_id = request.user.pk
+        granularity = request.GET.get("granularity", m.UserTrafficLog.GRANULARITY_DAY)
+        if granularity not in m.UserTrafficLog.GRANULARITIES:
+            return HttpResponseBadRequest("invalid granularity")
+        try:
+            start, end = self.get_window(request, granularity)
+        except ValueError:
+            return HttpResponseBadRequest("invalid start or end")
+        if granularity == m.UserTrafficLog.GRANULARITY_HOUR:
+            buckets = int((end - start.start_of("hour")).total_seconds() // 3600) + 1
+        else:
+            buckets = (end.date() - start.date()).days + 1
+        if not 0 < buckets <= self.MAX_BUCKETS:
+            return HttpResponseBadRequest("invalid start or end")
         configs = DashBoardManger.gen_traffic_line_chart_configs(
-            user_id, node_id, gen_datetime_list(get_current_datetime())
+            user_id, node_id, start, end, granularity
         )
         return JsonResponse(configs)
 
@@ -205,11 +283,17 @@ class ProxyConfigsView(View):
         return super(ProxyConfigsView, self).dispatch(*args, **kwargs)
 
     @method_decorator(api_authorized)
-    def get(self, request, node_id):
-        node = m.ProxyNode.get_or_none(node_id)
-        return (
-            JsonResponse(node.get_proxy_configs()) if node else HttpResponseBadRequest()
+    @method_decorator(
+        condition(
+            etag_func=lambda request, node_id: m.ProxyNode.get_config_version(node_id)
         )
+    )
+    def get(self, request, node_id):
+        since = request.GET.get("since")
+        snapshot = m.ProxyNode.get_proxy_configs_snapshot(node_id, since)
+        if snapshot is None:
+            return HttpResponseBadRequest()
+        return HttpResponse(snapshot, content_type="application/json")
 
     @method_decorator(handle_json_request)
     @method_decorator(api_authorized)
@@ -217,9 +301,17 @@ class ProxyConfigsView(View):
         node = m.ProxyNode.get_or_none(node_id)
         if not node:
             return HttpResponseBadRequest()
-        tasks.sync_user_traffic_task.delay(node_id, request.json)
+        self.report_traffic(node, request.json)
         return JsonResponse(data={})
 
+    @classmethod
+    def report_traffic(cls, node, data):
+        presence.touch_node(node.id, [int(d["user_id"]) for d in data.get("data", [])])
+        if settings.TRAFFIC_BUFFER_ENABLED:
+            traffic_buffer.push(node, data)
+        else:
+            tasks.sync_user_traffic_task.delay(node.id, data)
+
 
 class EhcoRelayConfigView(View):
     """中转机器"""
@@ -229,9 +321,16 @@ class EhcoRelayConfigView(View):
         return super(EhcoRelayConfigView, self).dispatch(*args, **kwargs)
 
     @method_decorator(api_authorized)
+    @method_decorator(
+        condition(
+            etag_func=lambda request, node_id: m.RelayNode.get_config_version(node_id)
+        )
+    )
     def get(self, request, node_id):
-        node: m.RelayNode = m.RelayNode.get_or_none(node_id)
-        return JsonResponse(node.get_config()) if node else HttpResponseBadRequest()
+        snapshot = m.RelayNode.get_config_snapshot(node_id)
+        if snapshot is None:
+            return HttpResponseBadRequest()
+        return HttpResponse(snapshot, content_type="application/json")
 
     @method_decorator(handle_json_request)
     @method_decorator(api_authorized)
@@ -239,22 +338,17 @@ class EhcoRelayConfigView(View):
         node: m.RelayNode = m.RelayNode.get_or_none(node_id)
         if not node:
             return HttpResponseBadRequest()
-        if not request.json:
-            return JsonResponse(data={})
-
-        # TODO make this async
-        rules: List[m.RelayRule] = node.relay_rules.all()
-        name_rule_map = {rule.name: rule for rule in rules}
-        for data in request.json:
-            name = data["relay_label"]
-            if name in name_rule_map:
-                rule = name_rule_map[name]
-                rule.up_traffic += data["stats"]["up"] * node.enlarge_scale
-                rule.down_traffic += data["stats"]["down"] * node.enlarge_scale
-        for rule in rules:
-            rule.save()
+        if request.json:
+            self.report_traffic(node, request.json)
         return JsonResponse(data={})
 
+    @classmethod
+    def report_traffic(cls, node, data):
+        if settings.TRAFFIC_BUFFER_ENABLED:
+            traffic_buffer.push_relay(node, data)
+        else:
+            tasks.sync_relay_traffic_task.delay(node.id, data)
+
 
 class UserCheckInView(View):
     @method_decorator(login_required)
@@ -0,0 +1,18 @@
+"""
+ASGI config for django_sspanel project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+节点和订阅接口在这里会切换成异步的 view，可以用任意 ASGI server 启动，比如:
+uvicorn apps.asgi:application
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "configs")
+os.environ.setdefault("ASYNC_VIEWS_ENABLED", "true")
+application = get_asgi_application()
@@ -5,6 +5,8 @@ from apps.extensions.alipay import Pay
 from apps.extensions.cachext import RedisCache
 from apps.extensions.encoder import Encoder
 from apps.extensions.lock import LockManager
+from apps.extensions.presence import PresenceManager
+from apps.extensions.version import VersionManager, VersionWatcher
 
 # register pay instance
 pay = Pay()
@@ -13,10 +15,24 @@ pay = Pay()
 redis = Redis.from_url(settings.REDIS_DB_URI)
 
 # register cache
-cache = RedisCache(settings.REDIS_CACHE_URI)
+cache = RedisCache(
+    settings.REDIS_CACHE_URI,
+    local_maxsize=settings.CACHE_LOCAL_MAXSIZE,
+    serializer=settings.CACHE_SERIALIZER,
+    compress_threshold=settings.CACHE_COMPRESS_THRESHOLD,
+)
 
 # register encoder
 encoder = Encoder()
 
 # register lock manager
 lock = LockManager(redis_client=redis)
+
+# register version manager
+version = VersionManager(redis_client=redis)
+
+# register presence manager
+presence = PresenceManager(redis_client=redis)
+
+# register version watcher
+version_watcher = VersionWatcher(redis_client=redis)
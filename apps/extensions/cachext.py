@@ -1,11 +1,24 @@
 import functools
-import pickle
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
 import redis
 from pendulum import DateTime
+from redis.lock import LockError
+
+from apps.extensions.codec import Codec, CodecError
 
 DEFAULT_KEY_TYPES = (str, int, float, bool, DateTime)
 
+# NOTE 区分"没有缓存"和"缓存的值是 None"，get 的时候把 MISSING 当默认值传进去
+MISSING = object()
+
 
 def norm_cache_key(v):
     if isinstance(v, type):
@@ -29,11 +42,47 @@ def make_default_key(f, *args, **kwargs):
 
 
 class cached:
+    """
+    缓存函数的返回值，默认只是简单的 get -> 计算 -> set，热点 key 可以按需打开:
+
+    lock: 缓存失效时只让一个进程重新计算，其他进程等它算完直接读缓存，get_many 也一样
+    stale_ttl: 过期后旧值继续保留的秒数，有进程在重新计算时其他进程直接返回旧值
+    early_expire: 按 XFetch 算法在过期前随机提前重新计算，越大越早，一般用 1
+    local_ttl: 在进程内的 LRU 里再缓存的秒数，命中时不用访问 redis
+    none_ttl: 返回 None 时也缓存的秒数，默认不缓存 None
+    serializer: 默认按 json 存，返回 model 之类的对象时要指定 pickle
+    tags: 和被装饰的函数参数一样，返回这个结果的 tag 列表，可以按 tag 批量删除缓存
+    NOTE 进程内缓存返回的是同一个对象，调用方不要修改它
+    NOTE 打开 stale_ttl/early_expire 后缓存里存的是 (value, 计算耗时, 过期时间)
+    """
+
     client = None
 
-    def __init__(self, func=None, ttl=60 * 60, cache_key=make_default_key):
+    def __init__(
+        self,
+        func=None,
+        ttl=60 * 60,
+        cache_key=make_default_key,
+        lock=False,
+        stale_ttl=0,
+        early_expire=0,
+        lock_timeout=10,
+        local_ttl=0,
+        none_ttl=0,
+        serializer=None,
+        tags=None,
+    ):
         self.ttl = ttl
         self.cache_key = cache_key
+        self.lock = lock
+        self.stale_ttl = stale_ttl
+        self.early_expire = early_expire
+        self.lock_timeout = lock_timeout
+        self.local_ttl = local_ttl
+        self.none_ttl = none_ttl
+        self.serializer = serializer
+        self.tags = tags
+        self.envelope = bool(stale_ttl or early_expire)
         if func is not None:
             func = self.decorator(func)
         self.func = func
@@ -47,66 +96,426 @@ class cached:
     def __getattr__(self, name):
         return getattr(self.func, name)
 
+    def _make_entry(self, rv, delta):
+        """返回 (缓存里存的值, redis 的 ttl)"""
+        ttl = self.ttl if rv is not None else self.none_ttl
+        if self.envelope:
+            return (rv, delta, time.time() + ttl), ttl + self.stale_ttl
+        return rv, ttl
+
+    def _compute(self, f, key, args, kwargs):
+        start = time.time()
+        rv = f(*args, **kwargs)
+        if rv is None and not self.none_ttl:
+            return rv
+        entry, ttl = self._make_entry(rv, time.time() - start)
+        tags = self.tags(*args, **kwargs) if self.tags else None
+        self.client.set(key, entry, ttl, serializer=self.serializer, tags=tags)
+        return rv
+
+    def _store_many(self, keys, args_list, values, delta):
+        """按 ttl 分组，每组一次 set_many"""
+        groups = {}
+        for key, args, rv in zip(keys, args_list, values):
+            if rv is None and not self.none_ttl:
+                continue
+            entry, ttl = self._make_entry(rv, delta)
+            mapping, tags = groups.setdefault(ttl, ({}, {}))
+            mapping[key] = entry
+            if self.tags:
+                tags[key] = self.tags(*args)
+        for ttl, (mapping, tags) in groups.items():
+            self.client.set_many(mapping, ttl, serializer=self.serializer, tags=tags)
+
+    def _get_fresh(self, entry, early=False):
+        """没过期的时候返回缓存的值，没有缓存或者过期了返回 MISSING"""
+        if entry is MISSING or not self.envelope:
+            return entry
+        rv, delta, expire_at = entry
+        now = time.time()
+        if early and self.early_expire:
+            # NOTE 计算越慢、越接近过期时间，越有可能提前重新计算
+            now -= delta * self.early_expire * math.log(1 - random.random())
+        return rv if now < expire_at else MISSING
+
+    def _compute_once(self, f, key, args, kwargs, stale=MISSING):
+        """
+        加锁重新计算，同一时间只有一个进程在算
+
+        有旧值时不等锁，拿不到锁直接返回旧值；没有旧值时等锁，
+        等到锁之后先看看别的进程是不是已经算好了
+        """
+        lock = self.client.lock(f"lock.cached.{key}", timeout=self.lock_timeout)
+        if not lock.acquire(
+            blocking=stale is MISSING, blocking_timeout=self.lock_timeout
+        ):
+            if stale is not MISSING:
+                return stale
+            # NOTE 等锁超时了，不再等下去，自己算
+            return self._compute(f, key, args, kwargs)
+        try:
+            if stale is MISSING:
+                entry = self.client.get(key, MISSING, serializer=self.serializer)
+                rv = self._get_fresh(entry)
+                if rv is not MISSING:
+                    return rv
+            return self._compute(f, key, args, kwargs)
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
+
+    def _get_or_compute(self, f, key, args, kwargs):
+        entry = self.client.get(key, MISSING, serializer=self.serializer)
+        rv = self._get_fresh(entry, early=True)
+        if rv is not MISSING:
+            return rv
+        if entry is not MISSING:
+            # 过期或者提前过期了，旧值还在
+            return self._compute_once(f, key, args, kwargs, stale=entry[0])
+        if self.lock:
+            return self._compute_once(f, key, args, kwargs)
+        return self._compute(f, key, args, kwargs)
+
     def decorator(self, f):
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
             key = wrapper.make_cache_key(*args, **kwargs)
-            rv = self.client.get(key)
-            if rv is None:
-                rv = f(*args, **kwargs)
+            if not self.local_ttl:
+                return self._get_or_compute(f, key, args, kwargs)
+            rv = self.client.get_local(key, MISSING)
+            if rv is MISSING:
+                rv = self._get_or_compute(f, key, args, kwargs)
                 if rv is not None:
-                    self.client.set(key, rv, wrapper.ttl)
+                    self.client.set_local(key, rv, self.local_ttl)
+                elif self.none_ttl:
+                    ttl = min(self.local_ttl, self.none_ttl)
+                    self.client.set_local(key, rv, ttl)
             return rv
 
+        def with_local_prefix(key):
+            # NOTE 进程内缓存的 key 都带上前缀，写入/删除时只有这些 key 要广播失效
+            return self.client.LOCAL_KEY_PREFIX + key if self.local_ttl else key
+
         def make_cache_key(*args, **kwargs):
             if callable(self.cache_key):
-                return self.cache_key(f, *args, **kwargs)
+                return with_local_prefix(self.cache_key(f, *args, **kwargs))
             else:
-                return self.cache_key
+                return with_local_prefix(self.cache_key)
+
+        def fill(keys, results, misses, args_list, compute):
+            """算出没命中的结果写回缓存，结果填进 results"""
+            start = time.time()
+            miss_args = [args_list[i] for i in misses]
+            values = compute(miss_args) if compute else [f(*a) for a in miss_args]
+            delta = (time.time() - start) / len(misses)
+            self._store_many([keys[i] for i in misses], miss_args, values, delta)
+            for i, rv in zip(misses, values):
+                results[i] = rv
+
+        def fill_once(keys, results, misses, args_list, compute):
+            """和 _compute_once 一样，等到锁之后先看看别的进程是不是已经算好了"""
+            miss_keys = [keys[i] for i in misses]
+            digest = hashlib.md5("\n".join(miss_keys).encode()).hexdigest()
+            lock = self.client.lock(
+                f"lock.cached.many.{digest}", timeout=self.lock_timeout
+            )
+            if not lock.acquire(blocking_timeout=self.lock_timeout):
+                # NOTE 等锁超时了，不再等下去，自己算
+                return fill(keys, results, misses, args_list, compute)
+            try:
+                entries = self.client.get_many(
+                    miss_keys, MISSING, serializer=self.serializer
+                )
+                for i, entry in zip(misses, entries):
+                    results[i] = self._get_fresh(entry)
+                misses = [i for i in misses if results[i] is MISSING]
+                if misses:
+                    fill(keys, results, misses, args_list, compute)
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    pass
+
+        def get_many(args_list, compute=None):
+            """
+            批量读缓存: 一次 MGET，没命中的交给 compute 一起算，再分批用 pipeline 写回
+
+            args_list 是每次调用的位置参数 tuple，compute(misses) 要按顺序返回
+            misses 的结果，比如用一个 GROUP BY 查出来，不传就一个一个调用原函数
+            打开 lock 时没命中的这一批 key 一起加一把锁，同样的请求只算一次
+            NOTE 批量读不返回旧值，过期的直接当成没命中
+            """
+            args_list = [tuple(args) for args in args_list]
+            keys = [make_cache_key(*args) for args in args_list]
+            results = [MISSING] * len(keys)
+            if self.local_ttl:
+                results = [self.client.get_local(key, MISSING) for key in keys]
+            todo = [i for i, rv in enumerate(results) if rv is MISSING]
+            if not todo:
+                return results
+            entries = self.client.get_many(
+                [keys[i] for i in todo], MISSING, serializer=self.serializer
+            )
+            for i, entry in zip(todo, entries):
+                results[i] = self._get_fresh(entry)
+            misses = [i for i in todo if results[i] is MISSING]
+            if misses and self.lock:
+                fill_once(keys, results, misses, args_list, compute)
+            elif misses:
+                fill(keys, results, misses, args_list, compute)
+            if self.local_ttl:
+                for i in todo:
+                    if results[i] is not None:
+                        self.client.set_local(keys[i], results[i], self.local_ttl)
+            return results
+
+        def invalidate(*args, **kwargs):
+            return self.client.delete(make_cache_key(*args, **kwargs))
+
+        def invalidate_all():
+            """删掉这个函数所有的缓存，只支持默认的 cache_key"""
+            return self.client.delete_by_prefix(with_local_prefix(make_default_key(f)))
 
         wrapper.uncached = f
         wrapper.ttl = self.ttl
         wrapper.make_cache_key = make_cache_key
+        wrapper.get_many = get_many
+        wrapper.invalidate = invalidate
+        wrapper.invalidate_all = invalidate_all
 
         return wrapper
 
 
+class LocalCache:
+    """进程内的 LRU 缓存，每个 key 有自己的过期时间，超过 maxsize 淘汰最久没用的"""
+
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expire_at = item
+            if expire_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
 class RedisClient:
-    def __init__(self, uri):
+    """
+    redis 缓存，序列化见 Codec，默认按 json 存，需要 pickle 的地方要自己指定
+
+    local_maxsize 大于 0 时多一层进程内的 LRU 缓存(只给 cached(local_ttl=...) 用)，
+    写入/删除 LOCAL_KEY_PREFIX 开头的 key 时会在 INVALIDATE_CHANNEL 上广播，
+    每次调用合并成一条消息，其他进程下次读本地缓存前非阻塞地收一下消息，删掉失效的 key
+    NOTE uwsgi 没有开线程，所以不用后台线程订阅
+    """
+
+    INVALIDATE_CHANNEL = "cache.invalidate"
+    LOCAL_KEY_PREFIX = "local."
+    # NOTE 批量写入/删除时每个 pipeline 里最多的 key 数量
+    BATCH_SIZE = 1000
+
+    def __init__(self, uri, local_maxsize=0, serializer="json", compress_threshold=0):
         self._pool = redis.ConnectionPool.from_url(uri)
         self._client = redis.Redis(connection_pool=self._pool)
+        self._codec = Codec(serializer, compress_threshold)
+        self._local = LocalCache(local_maxsize) if local_maxsize > 0 else None
+        self._pubsub = None
+        self._pubsub_pid = None
+        self._pubsub_lock = threading.Lock()
+        self._sender_id = uuid.uuid4().hex
+
+    def _get_sender(self):
+        # NOTE 带上 pid，fork 出来的进程之间也能区分开
+        return f"{self._sender_id}.{os.getpid()}"
+
+    def _sync_local(self):
+        """收其他进程发来的失效消息，连接有问题时清空本地缓存"""
+        if not self._pubsub_lock.acquire(blocking=False):
+            return
+        try:
+            # NOTE fork 出来的子进程不能复用父进程的连接
+            if self._pubsub is None or self._pubsub_pid != os.getpid():
+                self._local.clear()
+                self._pubsub = self._client.pubsub()
+                self._pubsub.subscribe(self.INVALIDATE_CHANNEL)
+                self._pubsub_pid = os.getpid()
+            while True:
+                message = self._pubsub.get_message()
+                if message is None:
+                    break
+                if message["type"] != "message":
+                    continue
+                # 自己发出的消息不用管，本地缓存已经删过了
+                sender, *keys = message["data"].decode().split("\n")
+                if sender != self._get_sender():
+                    self._local.delete_many(keys)
+        except redis.RedisError:
+            self._local.clear()
+            self._pubsub = None
+        finally:
+            self._pubsub_lock.release()
+
+    def _invalidate_local(self, pipe, keys):
+        if self._local is None:
+            return
+        keys = [k for k in keys if k.startswith(self.LOCAL_KEY_PREFIX)]
+        if not keys:
+            return
+        self._local.delete_many(keys)
+        # NOTE key 里可能有空格，用换行分隔
+        pipe.publish(self.INVALIDATE_CHANNEL, "\n".join([self._get_sender(), *keys]))
+
+    def get_local(self, key, default=None):
+        if self._local is None:
+            return default
+        self._sync_local()
+        return self._local.get(key, default)
+
+    def set_local(self, key, value, ttl):
+        if self._local is not None:
+            self._local.set(key, value, ttl)
 
-    def get(self, key):
-        v = self._client.get(key)
-        return v if v is None else pickle.loads(v)
+    def _loads(self, v, default, serializer):
+        if v is None:
+            return default
+        try:
+            return self._codec.loads(v, serializer)
+        except CodecError:
+            # NOTE 格式对不上(比如没指定 pickle 读到了 pickle 的数据)当成没有缓存
+            return default
 
-    def get_many(self, keys):
+    def get(self, key, default=None, serializer=None):
+        return self._loads(self._client.get(key), default, serializer)
+
+    def get_many(self, keys, default=None, serializer=None):
         values = self._client.mget(keys)
-        return [v if v is None else pickle.loads(v) for v in values]
+        return [self._loads(v, default, serializer) for v in values]
 
-    def set(self, key, value, ttl=60 * 5):
-        return self._client.set(key, pickle.dumps(value), ex=ttl)
+    def _tag_key(self, tag):
+        return f"tag.{tag}"
 
-    def set_many(self, mapping, ttl=60 * 5):
-        mapping = {k: pickle.dumps(v) for k, v in mapping.items()}
-        rv = self._client.mset(mapping)
-        for k in mapping:
-            self._client.expire(k, ttl)
-        return rv
+    def _add_tags(self, pipe, keys, tags, ttl):
+        """
+        tag 用 set 记录属于它的 key
+
+        NOTE tag 的过期时间跟着最后一次写入走，同一个 tag 下的 key 的 ttl 最好一样
+        """
+        for tag in tags or []:
+            tag_key = self._tag_key(tag)
+            pipe.sadd(tag_key, *keys)
+            pipe.expire(tag_key, ttl)
+
+    def set(self, key, value, ttl=60 * 5, serializer=None, tags=None):
+        pipe = self._client.pipeline(transaction=False)
+        pipe.set(key, self._codec.dumps(value, serializer), ex=ttl)
+        self._add_tags(pipe, [key], tags, ttl)
+        self._invalidate_local(pipe, [key])
+        return pipe.execute()[0]
+
+    def set_many(self, mapping, ttl=60 * 5, serializer=None, tags=None):
+        """
+        按 BATCH_SIZE 分批用 pipeline 写入，每批一次网络往返
+
+        tags 可以是所有 key 共用的列表，也可以是 {key: tags}
+        """
+        items = list(mapping.items())
+        for i in range(0, len(items), self.BATCH_SIZE):
+            chunk = items[i : i + self.BATCH_SIZE]
+            pipe = self._client.pipeline(transaction=False)
+            for k, v in chunk:
+                pipe.set(k, self._codec.dumps(v, serializer), ex=ttl)
+            keys = [k for k, _ in chunk]
+            if isinstance(tags, dict):
+                for k in keys:
+                    self._add_tags(pipe, [k], tags.get(k), ttl)
+            else:
+                self._add_tags(pipe, keys, tags, ttl)
+            self._invalidate_local(pipe, keys)
+            pipe.execute()
+        return True
 
     def delete(self, key):
-        return self._client.delete(key)
+        pipe = self._client.pipeline(transaction=False)
+        pipe.delete(key)
+        self._invalidate_local(pipe, [key])
+        return pipe.execute()[0]
 
     def delete_many(self, keys):
-        if keys:
-            return self._client.delete(*keys)
-        return False
+        """按 BATCH_SIZE 分批删除，返回删掉的数量"""
+        keys = list(keys)
+        count = 0
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            chunk = keys[i : i + self.BATCH_SIZE]
+            pipe = self._client.pipeline(transaction=False)
+            pipe.delete(*chunk)
+            self._invalidate_local(pipe, chunk)
+            count += pipe.execute()[0]
+        return count
+
+    def delete_tags(self, *tags):
+        """删掉这些 tag 下所有的 key"""
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        pipe = self._client.pipeline(transaction=False)
+        for tag_key in tag_keys:
+            pipe.smembers(tag_key)
+        keys = [k.decode() for members in pipe.execute() for k in members]
+        return self.delete_many(keys + tag_keys)
+
+    def delete_by_prefix(self, prefix):
+        """
+        用 SCAN 找出前缀匹配的 key 分批删除
+
+        NOTE 要遍历整个库，只适合偶尔的手动清理，经常要删的用 tag
+        """
+        count = 0
+        keys = []
+        for key in self._client.scan_iter(match=f"{prefix}*", count=self.BATCH_SIZE):
+            keys.append(key.decode())
+            if len(keys) >= self.BATCH_SIZE:
+                count += self.delete_many(keys)
+                keys = []
+        return count + self.delete_many(keys)
+
+    def lock(self, name, timeout=10):
+        return self._client.lock(name, timeout=timeout)
 
 
 class RedisCache:
-    def __init__(self, uri):
+    def __init__(self, uri, local_maxsize=0, serializer="json", compress_threshold=0):
         # register cached attr
-        self._client = RedisClient(uri)
+        self._client = RedisClient(
+            uri,
+            local_maxsize=local_maxsize,
+            serializer=serializer,
+            compress_threshold=compress_threshold,
+        )
         self.cached = cached
         self.cached.client = self._client
 
@@ -0,0 +1,103 @@
+import json
+import pickle
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec:
+    """
+    缓存值的序列化，存进去的数据是 1 字节的格式标记 + 内容
+
+    j: json(装了 orjson 就用 orjson)  m: msgpack  p: pickle  b: 原始的 bytes
+    超过 compress_threshold 的数据会压缩，前面再加一个字节 s: zstd z: zlib
+    NOTE 只有读的时候指定了 pickle 才会 pickle.loads，
+    redis 里被写进了恶意数据也不会执行代码
+    """
+
+    SERIALIZERS = ("json", "msgpack", "pickle")
+    # NOTE 没有格式标记的老数据都是 pickle，开头是 pickle 的协议号
+    LEGACY_PICKLE = 0x80
+
+    def __init__(self, serializer="json", compress_threshold=0):
+        self.serializer = self._check_serializer(serializer)
+        self.compress_threshold = compress_threshold
+
+    def _check_serializer(self, serializer):
+        if serializer not in self.SERIALIZERS:
+            raise ValueError(f"not support serializer: {serializer}")
+        if serializer == "msgpack" and msgpack is None:
+            raise ValueError("serializer msgpack requires the msgpack package")
+        return serializer
+
+    def _serialize(self, value, serializer):
+        if isinstance(value, bytes):
+            return b"b" + value
+        if serializer == "json":
+            if orjson is not None:
+                return b"j" + orjson.dumps(value)
+            return b"j" + json.dumps(value, separators=(",", ":")).encode()
+        if serializer == "msgpack":
+            return b"m" + msgpack.packb(value)
+        return b"p" + pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _deserialize(self, data, allow_pickle):
+        tag, body = data[:1], data[1:]
+        if tag == b"b":
+            return body
+        if tag == b"j":
+            return orjson.loads(body) if orjson is not None else json.loads(body)
+        if tag == b"m" and msgpack is not None:
+            return msgpack.unpackb(body, strict_map_key=False)
+        if tag == b"p" and allow_pickle:
+            return pickle.loads(body)
+        raise CodecError(f"can not decode value with tag: {tag}")
+
+    def _compress(self, data):
+        if zstandard is not None:
+            return b"s" + zstandard.compress(data)
+        return b"z" + zlib.compress(data, 1)
+
+    def _decompress(self, data):
+        tag, body = data[:1], data[1:]
+        if tag == b"s":
+            if zstandard is None:
+                raise CodecError("value compressed by zstd but zstandard not found")
+            return zstandard.decompress(body)
+        if tag == b"z":
+            return zlib.decompress(body)
+        return data
+
+    def dumps(self, value, serializer=None) -> bytes:
+        data = self._serialize(
+            value, self._check_serializer(serializer or self.serializer)
+        )
+        if self.compress_threshold and len(data) > self.compress_threshold:
+            return self._compress(data)
+        return data
+
+    def loads(self, data: bytes, serializer=None):
+        """数据的格式和 serializer 不一致也能读，只是 pickle 必须显式指定"""
+        allow_pickle = (serializer or self.serializer) == "pickle"
+        if data[0] == self.LEGACY_PICKLE:
+            if not allow_pickle:
+                raise CodecError("can not decode legacy pickle value")
+            return pickle.loads(data)
+        return self._deserialize(self._decompress(data), allow_pickle)
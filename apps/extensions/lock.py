@@ -52,3 +52,7 @@ class LockManager:
     def user_checkin_lock(self, user_id: int):
         key = f"lock.user_checkin_lock.{user_id}"
         return GlobalLock(key, self._redis_client, blocking=False)
+
+    def traffic_buffer_flush_lock(self):
+        key = "lock.traffic_buffer_flush_lock"
+        return GlobalLock(key, self._redis_client, blocking=False)
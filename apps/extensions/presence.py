@@ -0,0 +1,66 @@
+import time
+import uuid
+
+
+class PresenceManager:
+    """
+    用 redis 有序集合记录节点/用户的在线状态，score 是最后上报的时间戳
+
+    presence.proxy_nodes: 所有节点
+    presence.proxy_node.{id}: 节点上的用户
+    在线数量只需要 ZCOUNT 一下，过期的成员按 score 清理
+    """
+
+    NODES_KEY = "presence.proxy_nodes"
+
+    def __init__(self, redis_client, keep_seconds=60 * 10) -> None:
+        self._redis_client = redis_client
+        # NOTE 超过这个时间的成员会被清理掉，要比查询的时间窗口大
+        self._keep_seconds = keep_seconds
+
+    def _node_key(self, node_id: int):
+        return f"presence.proxy_node.{node_id}"
+
+    def touch_node(self, node_id: int, user_ids: list):
+        """节点上报时调用，没有用户也要记一下，用来表示节点在线"""
+        now = time.time()
+        stale = now - self._keep_seconds
+        key = self._node_key(node_id)
+        pipe = self._redis_client.pipeline(transaction=False)
+        pipe.zadd(self.NODES_KEY, {node_id: now})
+        pipe.zremrangebyscore(self.NODES_KEY, "-inf", stale)
+        if user_ids:
+            pipe.zadd(key, {user_id: now for user_id in user_ids})
+        pipe.zremrangebyscore(key, "-inf", stale)
+        pipe.expire(key, self._keep_seconds)
+        pipe.execute()
+
+    def is_node_online(self, node_id: int, seconds: int) -> bool:
+        score = self._redis_client.zscore(self.NODES_KEY, node_id)
+        return score is not None and score >= time.time() - seconds
+
+    def get_node_online_user_count(self, node_id: int, seconds: int) -> int:
+        return self._redis_client.zcount(
+            self._node_key(node_id), time.time() - seconds, "+inf"
+        )
+
+    def get_online_node_ids(self, seconds: int) -> list:
+        return [
+            int(node_id)
+            for node_id in self._redis_client.zrangebyscore(
+                self.NODES_KEY, time.time() - seconds, "+inf"
+            )
+        ]
+
+    def get_online_user_count(self, seconds: int) -> int:
+        """所有节点合并去重后的在线用户数"""
+        keys = [self._node_key(i) for i in self.get_online_node_ids(seconds)]
+        if not keys:
+            return 0
+        # NOTE redis 6.2 才有 ZUNION，先合并到一个临时 key 里再数
+        tmp_key = f"presence.tmp.{uuid.uuid4().hex}"
+        pipe = self._redis_client.pipeline()
+        pipe.zunionstore(tmp_key, keys, aggregate="MAX")
+        pipe.zcount(tmp_key, time.time() - seconds, "+inf")
+        pipe.delete(tmp_key)
+        return pipe.execute()[1]
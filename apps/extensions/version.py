@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class VersionManager:
+    """
+    用 redis 计数器记录数据的版本号，数据变动时自增
+
+    拼接多个计数器作为最终的版本号，只要有一个变了版本号就会变
+    自增的同时会把计数器的 key 发布到 CHANNEL 上，长轮询的请求靠它唤醒
+    """
+
+    TOPOLOGY_KEY = "version.proxy_topology"
+    USERS_KEY = "version.proxy_users"
+    OCCUPANCY_KEY = "version.proxy_occupancy"
+    CHANNEL = "version.changed"
+
+    def __init__(self, redis_client) -> None:
+        self._redis_client = redis_client
+
+    def _get(self, *keys) -> str:
+        return ".".join(str(int(v or 0)) for v in self._redis_client.mget(keys))
+
+    def _incr(self, *keys):
+        pipe = self._redis_client.pipeline()
+        for key in keys:
+            pipe.incr(key)
+        for key in keys:
+            pipe.publish(self.CHANNEL, key)
+        return pipe.execute()[0]
+
+    def _proxy_node_key(self, node_id: int):
+        return f"version.proxy_node.{node_id}"
+
+    def get_proxy_node_config_keys(self, node_id: int) -> list:
+        return [self.TOPOLOGY_KEY, self.USERS_KEY, self._proxy_node_key(node_id)]
+
+    def get_proxy_node_config_version(self, node_id: int) -> str:
+        return self._get(*self.get_proxy_node_config_keys(node_id))
+
+    def get_topology_version(self) -> str:
+        return self._get(self.TOPOLOGY_KEY)
+
+    def get_occupancy_version(self) -> str:
+        return self._get(self.OCCUPANCY_KEY)
+
+    def get_subscription_version(self) -> str:
+        """用户能看到哪些节点只和节点拓扑/占用有关"""
+        return self._get(self.TOPOLOGY_KEY, self.OCCUPANCY_KEY)
+
+    def touch_topology(self):
+        """节点/中转/协议配置变动"""
+        return self._incr(self.TOPOLOGY_KEY)
+
+    def touch_users(self):
+        """用户密码/等级/流量状态变动"""
+        return self._incr(self.USERS_KEY)
+
+    def touch_proxy_node(self, node_id: int):
+        """节点占用用户变动"""
+        return self._incr(self._proxy_node_key(node_id), self.OCCUPANCY_KEY)
+
+
+def _wake_up(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class VersionWatcher:
+    """
+    订阅版本号变动的频道，让异步的 view 等待版本号变化(长轮询)
+
+    每个进程一个后台线程阻塞在 pubsub 上，收到某个 key 的变动后
+    唤醒所有在等这个 key 的协程
+    NOTE 只在 ASGI 下使用，后台线程在第一次 watch 的时候才启动
+    """
+
+    def __init__(self, redis_client, channel=VersionManager.CHANNEL) -> None:
+        self._redis_client = redis_client
+        self._channel = channel
+        self._waiters = defaultdict(set)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="version-watcher", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self._redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                for message in pubsub.listen():
+                    self._notify([message["data"].decode()])
+            except Exception:
+                logger.exception("version watcher error")
+                # NOTE 断线的时候可能漏掉消息，唤醒所有请求让它们重新检查版本号
+                with self._lock:
+                    keys = list(self._waiters)
+                self._notify(keys)
+                time.sleep(1)
+
+    def _notify(self, keys):
+        with self._lock:
+            waiters = set()
+            for key in keys:
+                waiters |= self._waiters.pop(key, set())
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake_up, future)
+
+    @asynccontextmanager
+    async def watch(self, keys):
+        """
+        返回一个 future，keys 里任意一个有变动时完成
+
+        NOTE 要先 watch 再检查版本号，不然两者之间的变动会被漏掉
+        """
+        if keys:
+            self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            for key in keys:
+                self._waiters[key].add(waiter)
+        try:
+            yield future
+        finally:
+            with self._lock:
+                for key in keys:
+                    waiters = self._waiters.get(key)
+                    if waiters is not None:
+                        waiters.discard(waiter)
+                        if not waiters:
+                            del self._waiters[key]
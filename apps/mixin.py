@@ -1,9 +1,14 @@
+import time
+
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import ValidationError
 from django.db import connection, models, transaction
+from django.db.models import Max
 from django.db.models.signals import post_delete, post_save, pre_save
 
+from apps.ext import redis
+
 
 class StaffRequiredMixin(LoginRequiredMixin):
     def dispatch(self, request, *args, **kwargs):
@@ -39,6 +44,58 @@ class BaseLogModel(BaseModel):
         abstract = True
 
 
+PURGE_BATCH_SIZE = 5000
+PURGE_SLEEP_SECONDS = 0.1
+PURGE_TIME_BUDGET_SECONDS = 50
+PURGE_CHECKPOINT_TTL = 60 * 60 * 24
+
+
+def bulk_purge(
+    query,
+    checkpoint="default",
+    batch_size=PURGE_BATCH_SIZE,
+    sleep_seconds=PURGE_SLEEP_SECONDS,
+    time_budget=PURGE_TIME_BUDGET_SECONDS,
+):
+    """
+    按主键范围分批删除 query 里的数据，返回 (删除的行数, 是否删完)
+    避免一条语句删太多行导致长时间锁表/复制延迟
+
+    每批删完会把删到的主键记在 redis 里，超时退出后下次从断点继续
+    checkpoint: 断点的名字，同一张表不同的删除条件要用不同的名字
+    NOTE 依赖主键随时间递增，用 _raw_delete 删除，不会触发信号和级联删除
+    """
+    model = query.model
+    key = f"purge_checkpoint.{model._meta.db_table}.{checkpoint}"
+
+    # NOTE 只删开始时已经存在的数据，不去追新写入的
+    max_pk = query.aggregate(max_pk=Max("pk"))["max_pk"]
+    lower = int(redis.get(key) or 0)
+    count = 0
+    start = time.monotonic()
+    while max_pk is not None and lower < max_pk:
+        batch = query.filter(pk__gt=lower, pk__lte=max_pk).order_by("pk")
+        pks = list(batch.values_list("pk", flat=True)[batch_size - 1 : batch_size])
+        upper = pks[0] if pks else max_pk
+        to_delete = query.filter(pk__gt=lower, pk__lte=upper)
+        count += to_delete._raw_delete(to_delete.db)
+        lower = upper
+        redis.set(key, lower, ex=PURGE_CHECKPOINT_TTL)
+        if time.monotonic() - start > time_budget:
+            break
+        time.sleep(sleep_seconds)
+
+    done = max_pk is None or lower >= max_pk
+    if done:
+        redis.delete(key)
+    cost = time.monotonic() - start
+    print(
+        f"{model.__name__} purged count:{count} done:{done} "
+        f"rows/s:{count / cost if cost else 0:.0f}"
+    )
+    return count, done
+
+
 class SequenceMixin(models.Model):
     """
     提供一个sequence(排序)字段表示该记录在所有记录中的顺序
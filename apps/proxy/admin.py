@@ -4,6 +4,7 @@ from django.db.models import F
 from django.utils.safestring import mark_safe
 
 from apps import utils
+from apps.mixin import bulk_purge
 from apps.proxy import models
 from apps.sspanel.models import User
 from apps.utils import traffic_format
@@ -129,13 +130,16 @@ class ProxyNodeAdmin(admin.ModelAdmin):
 
     def clear_traffic_logs(self, request, queryset):
         for node in queryset:
-            query = models.UserTrafficLog.objects.filter(proxy_node=node)
-            query.delete()
-            count = query._raw_delete(query.db)
+            count, done = bulk_purge(
+                models.UserTrafficLog.objects.filter(proxy_node=node),
+                checkpoint=f"node.{node.id}",
+                time_budget=10,
+            )
             messages.add_message(
                 request,
-                messages.SUCCESS,
-                f"{node}:'s traffic logs cleared count={count}",
+                messages.SUCCESS if done else messages.WARNING,
+                f"{node}:'s traffic logs cleared count={count}"
+                + ("" if done else " 还没删完，请再执行一次"),
             )
 
     clear_traffic_logs.short_description = "清除流量记录"
@@ -0,0 +1,103 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("proxy", "0029_proxynode_native_ip"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserTrafficHourlyRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "upload_traffic",
+                    models.BigIntegerField(default=0, verbose_name="上传流量"),
+                ),
+                (
+                    "download_traffic",
+                    models.BigIntegerField(default=0, verbose_name="下载流量"),
+                ),
+                ("bucket", models.DateTimeField(db_index=True, verbose_name="小时")),
+                (
+                    "proxy_node",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="proxy.proxynode",
+                        verbose_name="代理节点",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="用户",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "用户流量小时汇总",
+                "verbose_name_plural": "用户流量小时汇总",
+                "unique_together": {("user", "proxy_node", "bucket")},
+            },
+        ),
+        migrations.CreateModel(
+            name="UserTrafficDailyRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "upload_traffic",
+                    models.BigIntegerField(default=0, verbose_name="上传流量"),
+                ),
+                (
+                    "download_traffic",
+                    models.BigIntegerField(default=0, verbose_name="下载流量"),
+                ),
+                ("bucket", models.DateField(db_index=True, verbose_name="日期")),
+                (
+                    "proxy_node",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="proxy.proxynode",
+                        verbose_name="代理节点",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="用户",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "用户流量每日汇总",
+                "verbose_name_plural": "用户流量每日汇总",
+                "unique_together": {("user", "proxy_node", "bucket")},
+            },
+        ),
+    ]
@@ -0,0 +1,126 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:26
+
+import django.db.models.deletion
+import pendulum
+from django.conf import settings
+from django.db import migrations, models
+
+TABLE = "proxy_usertrafficlog"
+NEW_TABLE = f"{TABLE}_new"
+OLD_TABLE = f"{TABLE}_old"
+# NOTE 和 UserTrafficLog.PARTITION_DAYS_AHEAD 一样
+PARTITION_DAYS_AHEAD = 3
+COPY_BATCH_SIZE = 10000
+# NOTE 切换表的瞬间旧表可能还有新写入，新表的自增 id 跳过这一段避免冲突
+AUTO_INCREMENT_GAP = 100000
+
+
+def _partition_sql(date):
+    return (
+        f"PARTITION p{date:%Y%m%d} "
+        f"VALUES LESS THAN (TO_DAYS('{date.add(days=1):%Y-%m-%d}'))"
+    )
+
+
+def _get_max_id(cursor, table):
+    cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+    return cursor.fetchone()[0]
+
+
+def _copy_rows(cursor, src, dst, lower, upper):
+    """按 id 分批把 (lower, upper] 的记录拷过去，每批是一条短语句，不会长时间锁表"""
+    while lower < upper:
+        batch_upper = min(lower + COPY_BATCH_SIZE, upper)
+        cursor.execute(
+            f"INSERT INTO {dst} SELECT * FROM {src} WHERE id > %s AND id <= %s",
+            [lower, batch_upper],
+        )
+        lower = batch_upper
+    return lower
+
+
+def partition_traffic_log(apps, schema_editor):
+    """
+    NOTE 只有 mysql 需要分区，不直接 ALTER 原表(会重建整张表并且一直锁着)，
+    而是建一张分好区的新表，分批拷数据，最后 RENAME 原子地切换
+
+    1 新表按已有数据的日期范围建好每天的分区，过了保留天数可以直接删分区
+    2 分批拷贝，追到和原表差不多时调大新表的自增 id，然后切换
+    3 把切换前最后一刻写进旧表的记录补拷过去，删掉旧表
+    也可以 --fake 这个迁移，用 pt-online-schema-change 在线改主键并分区:
+    --alter "DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at)
+    PARTITION BY RANGE (TO_DAYS(created_at)) (...)"
+    """
+    if schema_editor.connection.vendor != "mysql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"SELECT MIN(created_at) FROM {TABLE}")
+        first = cursor.fetchone()[0]
+        today = pendulum.now("UTC").date()
+        date = pendulum.instance(first).date() if first else today
+        partitions = []
+        while date <= today.add(days=PARTITION_DAYS_AHEAD):
+            partitions.append(_partition_sql(date))
+            date = date.add(days=1)
+
+        cursor.execute(f"CREATE TABLE {NEW_TABLE} LIKE {TABLE}")
+        cursor.execute(
+            f"ALTER TABLE {NEW_TABLE} "
+            f"DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {NEW_TABLE} PARTITION BY RANGE (TO_DAYS(created_at)) ("
+            f"{', '.join(partitions)}, PARTITION p_max VALUES LESS THAN MAXVALUE)"
+        )
+
+        copied = 0
+        while (max_id := _get_max_id(cursor, TABLE)) - copied > COPY_BATCH_SIZE:
+            copied = _copy_rows(cursor, TABLE, NEW_TABLE, copied, max_id)
+        cursor.execute(
+            f"ALTER TABLE {NEW_TABLE} AUTO_INCREMENT = {max_id + AUTO_INCREMENT_GAP}"
+        )
+        cursor.execute(f"RENAME TABLE {TABLE} TO {OLD_TABLE}, {NEW_TABLE} TO {TABLE}")
+        _copy_rows(cursor, OLD_TABLE, TABLE, copied, _get_max_id(cursor, OLD_TABLE))
+        cursor.execute(f"DROP TABLE {OLD_TABLE}")
+
+
+def unpartition_traffic_log(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute(f"ALTER TABLE {TABLE} REMOVE PARTITIONING")
+    schema_editor.execute(f"ALTER TABLE {TABLE} DROP PRIMARY KEY, ADD PRIMARY KEY (id)")
+
+
+class Migration(migrations.Migration):
+    # NOTE mysql 的 DDL 本来就不在事务里，拷数据也要分批提交
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("proxy", "0030_traffic_rollup"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="usertrafficlog",
+            name="proxy_node",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="proxy.proxynode",
+                verbose_name="代理节点",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="usertrafficlog",
+            name="user",
+            field=models.ForeignKey(
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="用户",
+            ),
+        ),
+        migrations.RunPython(partition_traffic_log, unpartition_traffic_log),
+    ]
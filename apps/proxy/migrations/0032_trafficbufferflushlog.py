@@ -0,0 +1,43 @@
+# Generated by Django 4.2.11 on 2026-10-18 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("proxy", "0031_usertrafficlog_partition"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TrafficBufferFlushLog",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        auto_now_add=True,
+                        db_index=True,
+                        help_text="创建时间",
+                        verbose_name="创建时间",
+                    ),
+                ),
+                (
+                    "flush_id",
+                    models.CharField(max_length=32, unique=True, verbose_name="批次"),
+                ),
+            ],
+            options={
+                "verbose_name": "流量缓冲刷入记录",
+                "verbose_name_plural": "流量缓冲刷入记录",
+            },
+        ),
+    ]
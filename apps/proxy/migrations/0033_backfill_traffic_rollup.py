@@ -0,0 +1,86 @@
+from datetime import timezone as dt_timezone
+
+import pendulum
+from django.db import migrations, models
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+
+def _upsert(model, rows, connection):
+    # NOTE 和 BaseTrafficRollup._upsert 一样，迁移里拿不到 model 上的方法
+    unique_fields = (
+        ["user", "proxy_node", "bucket"]
+        if connection.features.supports_update_conflicts_with_target
+        else None
+    )
+    model.objects.bulk_create(
+        [
+            model(
+                user_id=row["user_id"],
+                proxy_node_id=row["proxy_node_id"],
+                bucket=row["bucket"],
+                upload_traffic=row["u"] or 0,
+                download_traffic=row["d"] or 0,
+            )
+            for row in rows
+        ],
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=["upload_traffic", "download_traffic"],
+    )
+
+
+def backfill_traffic_rollup(apps, schema_editor):
+    """
+    用还保留着的原始流量记录补上小时/每日汇总，按天分批，重复执行结果一样
+
+    NOTE 原始记录很多时这一步会比较久，也可以先 --fake 这个迁移，
+    之后再手动跑 rollup_traffic_task(hours=原始记录保留的小时数)
+    """
+    UserTrafficLog = apps.get_model("proxy", "UserTrafficLog")
+    UserTrafficHourlyRollup = apps.get_model("proxy", "UserTrafficHourlyRollup")
+    UserTrafficDailyRollup = apps.get_model("proxy", "UserTrafficDailyRollup")
+    connection = schema_editor.connection
+
+    logs = UserTrafficLog.objects.filter(user__isnull=False)
+    first = logs.aggregate(first=models.Min("created_at"))["first"]
+    if first is None:
+        return
+    tz = timezone.get_current_timezone()
+    now = pendulum.now(tz)
+    day = pendulum.instance(first).in_timezone(tz).start_of("day")
+    while day <= now:
+        end = day.add(days=1)
+        hourly_rows = (
+            logs.filter(created_at__gte=day, created_at__lt=end)
+            .annotate(bucket=TruncHour("created_at", tzinfo=dt_timezone.utc))
+            .values("user_id", "proxy_node_id", "bucket")
+            .annotate(u=models.Sum("upload_traffic"), d=models.Sum("download_traffic"))
+            .order_by()
+        )
+        _upsert(UserTrafficHourlyRollup, list(hourly_rows), connection)
+        daily_rows = (
+            UserTrafficHourlyRollup.objects.filter(bucket__gte=day, bucket__lt=end)
+            .values("user_id", "proxy_node_id")
+            .annotate(u=models.Sum("upload_traffic"), d=models.Sum("download_traffic"))
+            .order_by()
+        )
+        _upsert(
+            UserTrafficDailyRollup,
+            [dict(row, bucket=day.date()) for row in daily_rows],
+            connection,
+        )
+        day = end
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("proxy", "0032_trafficbufferflushlog"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_traffic_rollup, migrations.RunPython.noop, elidable=True
+        ),
+    ]
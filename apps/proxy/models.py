@@ -3,6 +3,7 @@ import json
 import random
 from copy import deepcopy
 from datetime import timedelta
+from datetime import timezone as dt_timezone
 from decimal import Decimal
 from functools import cached_property
 from typing import List
@@ -10,12 +11,15 @@ from urllib.parse import quote, urlencode
 
 import pendulum
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import F
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.db.models import F, Q
+from django.db.models.functions import TruncHour
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
 
 from apps import constants as c
 from apps import utils
-from apps.ext import cache
+from apps.ext import cache, presence, redis, version
 from apps.mixin import BaseLogModel, BaseModel, SequenceMixin
 from apps.sspanel.models import User
 
@@ -244,6 +248,26 @@ class ProxyNode(BaseNodeModel, SequenceMixin):
         "当前使用的下载带宽", default=0
     )
 
+    # 生成用户配置时需要读取的用户字段
+    USER_CONFIG_FIELDS = (
+        "id",
+        "proxy_password",
+        "total_traffic",
+        "upload_traffic",
+        "download_traffic",
+    )
+    USER_CONFIG_CHUNK_SIZE = 2000
+    # 这些字段只和流量统计有关，变动时不需要通知节点更新配置
+    TRAFFIC_FIELDS = frozenset(
+        [
+            "used_traffic",
+            "current_used_download_bandwidth_bytes",
+            "current_used_upload_bandwidth_bytes",
+        ]
+    )
+    # NOTE 进程内的订阅拓扑快照 (拓扑版本, 快照)
+    _topology_snapshot = None
+
     class Meta:
         verbose_name = "代理节点"
         verbose_name_plural = "代理节点"
@@ -253,7 +277,7 @@ class ProxyNode(BaseNodeModel, SequenceMixin):
         return f"{self.name}-{self.node_type}-{self.id}"
 
     @classmethod
-    @cache.cached()
+    @cache.cached(local_ttl=60, serializer="pickle")
     def get_by_id_with_cache(cls, id):
         return cls.objects.get(id=id)
 
@@ -271,25 +295,50 @@ class ProxyNode(BaseNodeModel, SequenceMixin):
         )
 
     @classmethod
-    def get_user_active_nodes(cls, user):
-        # 1. filter by user level
-        base_query = cls.get_active_nodes()
-        query = base_query.filter(level__lte=user.level)
-        # 2. filter out nodes that has been occupied by other users
-        occupied_node_ids = [
-            i["proxy_node_id"] for i in UserProxyNodeOccupancy.get_occupied_node_ids()
-        ]
-        not_occupied_node_ids = [
-            i["id"] for i in query.exclude(id__in=occupied_node_ids).values("id")
-        ]
-        # 3. add nodes that has been occupied by this user
-        user_occupied_node_ids = [
-            i["proxy_node_id"]
-            for i in UserProxyNodeOccupancy.get_user_occupied_node_ids(user)
-        ]
-        return base_query.filter(id__in=not_occupied_node_ids) | cls.objects.filter(
-            id__in=user_occupied_node_ids
+    def get_user_visible_nodes(cls, user) -> List[dict]:
+        """
+        一条查询算出用户能看到的节点 (id, node_type, native_ip)，按 sequence 排序
+        1. 用户等级够并且没有被别人占用的可用节点
+        2. 用户自己占用的节点 (就算节点关了也能看到)
+        NOTE 结果缓存在 user 对象上，同一个请求里的订阅/规则/用户信息可以复用
+        """
+        if (nodes := getattr(user, "_visible_nodes", None)) is not None:
+            return nodes
+        valid_occupancies = UserProxyNodeOccupancy._valid_occupancy_query()
+        nodes = list(
+            cls.objects.filter(
+                Q(enable=True, level__lte=user.level)
+                & ~Q(id__in=valid_occupancies.values("proxy_node_id"))
+                | Q(id__in=valid_occupancies.filter(user=user).values("proxy_node_id"))
+            )
+            .order_by("sequence")
+            .values("id", "node_type", "native_ip")
         )
+        user._visible_nodes = nodes
+        return nodes
+
+    @classmethod
+    def get_config_version(cls, node_id) -> str:
+        return version.get_proxy_node_config_version(node_id)
+
+    @classmethod
+    def get_config_version_keys(cls, node_id) -> list:
+        """组成配置版本号的计数器，长轮询的时候等这些 key 的变动"""
+        return version.get_proxy_node_config_keys(node_id)
+
+    @classmethod
+    def diff_user_configs(cls, old_configs: List[dict], new_configs: List[dict]):
+        old_map = {cfg["user_id"]: cfg for cfg in old_configs}
+        new_map = {cfg["user_id"]: cfg for cfg in new_configs}
+        return {
+            "added": [cfg for uid, cfg in new_map.items() if uid not in old_map],
+            "removed": [uid for uid in old_map if uid not in new_map],
+            "changed": [
+                cfg
+                for uid, cfg in new_map.items()
+                if uid in old_map and old_map[uid] != cfg
+            ],
+        }
 
     @classmethod
     def calc_total_traffic(cls):
@@ -301,23 +350,39 @@ class ProxyNode(BaseNodeModel, SequenceMixin):
     def get_by_ip(clc, ip: str):
         return clc.objects.filter(server=ip).first()
 
-    @cached_property
-    def have_oc_users(self) -> bool:
-        occupancies_query = UserProxyNodeOccupancy.get_node_occupancies(self)
-        return occupancies_query.count() > 0
-
-    def get_node_users(self):
-        # 1. if node is not enable, return empty list
+    def get_node_users(self, occupancy_map=None):
+        # 1. if node is not enable, return empty queryset
         if not self.enable:
-            return []
+            return User.objects.none()
         # 2. node occupied by users, return users
-        occupancies_query = UserProxyNodeOccupancy.get_node_occupancies(self)
-        if occupancies_query.count() > 0:
-            user_ids = occupancies_query.values("user_id")
-            return User.objects.filter(id__in=user_ids)
+        if occupancy_map is None:
+            occupancy_map = UserProxyNodeOccupancy.get_node_occupancy_map(self.id)
+        if occupancy_map:
+            return User.objects.filter(id__in=list(occupancy_map))
         # 3. shared node filter user that level >= node.level
         return User.objects.filter(level__gte=self.level)
 
+    def get_user_configs(self, proxy_cfg):
+        """
+        批量生成节点的用户配置
+
+        占用记录一次性加载成 user_id 为 key 的字典，用户用 values 流式读取，
+        不创建 model 实例，查询次数和用户数量无关
+        """
+        occupancy_map = UserProxyNodeOccupancy.get_node_occupancy_map(self.id)
+        users = self.get_node_users(occupancy_map).values(*self.USER_CONFIG_FIELDS)
+        user_configs = []
+        for user in users.iterator(chunk_size=self.USER_CONFIG_CHUNK_SIZE):
+            have_shared_traffic = user["total_traffic"] > (
+                user["download_traffic"] + user["upload_traffic"]
+            )
+            have_oc_traffic = user["id"] in occupancy_map
+            enable = self.enable and (have_shared_traffic or have_oc_traffic)
+            user_configs.append(
+                proxy_cfg.to_user_config(user["id"], user["proxy_password"], enable)
+            )
+        return user_configs
+
     def get_proxy_configs(self):
         if self.node_type == self.NODE_TYPE_SS:
             proxy_cfg = self.ss_config
@@ -327,11 +392,59 @@ class ProxyNode(BaseNodeModel, SequenceMixin):
             raise Exception("not support node type")
 
         configs = proxy_cfg.to_node_config(self)
-        configs["users"] = [
-            proxy_cfg.to_user_config(self, user) for user in self.get_node_users()
-        ]
+        configs["users"] = self.get_user_configs(proxy_cfg)
         return configs
 
+    @classmethod
+    def _user_configs_cache_key(cls, node_id, config_version):
+        return f"proxy_node.user_configs.{node_id}.{config_version}"
+
+    @classmethod
+    def _configs_snapshot_cache_key(cls, node_id, config_version):
+        return f"proxy_node.configs_snapshot.{node_id}.{config_version}"
+
+    @classmethod
+    def get_proxy_configs_snapshot(cls, node_id, since=None):
+        """
+        返回序列化好的节点配置(bytes)，节点不存在时返回 None
+
+        配置按版本号缓存，相关数据变动时信号会更新版本号，旧的缓存自然失效,
+        命中缓存时不需要查库。传入 since 并且该版本的用户配置还在缓存里时
+        只返回新增/删除/变动的用户
+        """
+        # NOTE 先取版本号再生成配置，中间有变动时下次请求会拿到新版本号
+        config_version = cls.get_config_version(node_id)
+        key = cls._configs_snapshot_cache_key(node_id, config_version)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            node = cls.get_or_none(node_id)
+            if not node:
+                return None
+            configs = node.get_proxy_configs()
+            configs["version"] = config_version
+            snapshot = json.dumps(configs, cls=DjangoJSONEncoder).encode()
+            cache.set_many(
+                {
+                    key: snapshot,
+                    cls._user_configs_cache_key(node_id, config_version): configs[
+                        "users"
+                    ],
+                },
+                c.CACHE_TTL_HOUR,
+            )
+        if since and since != config_version:
+            users, old_users = cache.get_many(
+                [
+                    cls._user_configs_cache_key(node_id, config_version),
+                    cls._user_configs_cache_key(node_id, since),
+                ]
+            )
+            if users is not None and old_users is not None:
+                delta = cls.diff_user_configs(old_users, users)
+                delta.update({"version": config_version, "since": since})
+                return json.dumps(delta, cls=DjangoJSONEncoder).encode()
+        return snapshot
+
     def get_ehco_server_config(self):
         if self.enable_ehco_tunnel:
             return {
@@ -357,7 +470,8 @@ class ProxyNode(BaseNodeModel, SequenceMixin):
         elif self.node_type == self.NODE_TYPE_TROJAN:
             return self.trojan_config.multi_user_port
 
-    def get_user_shadowrocket_sub_link(self, user, relay_rule=None):
+    def _get_sub_endpoint(self, relay_rule=None):
+        """订阅里和用户无关的部分"""
         if relay_rule:
             host = relay_rule.relay_host
             port = relay_rule.relay_port
@@ -368,37 +482,86 @@ class ProxyNode(BaseNodeModel, SequenceMixin):
             port = self.get_user_port()
             remark = self.remark
             udp = self.enable_udp
-        if self.node_type == self.NODE_TYPE_SS:
-            code = f"{self.ss_config.method}:{user.proxy_password}@{host}:{port}"
+        return {
+            "node_type": self.node_type,
+            "host": host,
+            "port": port,
+            "remark": remark,
+            "udp": udp,
+            "method": (
+                self.ss_config.method if self.node_type == self.NODE_TYPE_SS else None
+            ),
+        }
+
+    def _get_topology_entry(self):
+        """NOTE relays: [(去重的 key: relay_node_id+port, endpoint)]"""
+        return {
+            "direct": self._get_sub_endpoint() if self.enable_direct else None,
+            "relays": [
+                (f"{rule.relay_node.id}{rule.relay_port}", self._get_sub_endpoint(rule))
+                for rule in self.relay_rules.all()
+                if rule.relay_node.enable
+            ],
+        }
+
+    @classmethod
+    def get_topology_snapshot(cls):
+        """
+        所有可用节点的订阅内容，按拓扑版本缓存在进程内，拓扑变了才会重建
+        NOTE key: node_id value: _get_topology_entry
+        """
+        # NOTE 先读版本再查库，构建过程中拓扑变了下次请求也会重建
+        topology_version = version.get_topology_version()
+        if cls._topology_snapshot and cls._topology_snapshot[0] == topology_version:
+            return cls._topology_snapshot[1]
+        nodes = {
+            node.id: node._get_topology_entry()
+            for node in cls.get_active_nodes().prefetch_related(
+                "relay_rules__relay_node"
+            )
+        }
+        cls._topology_snapshot = (topology_version, nodes)
+        return nodes
+
+    @classmethod
+    def get_sub_topology(cls, node_ids: List[int]):
+        """按顺序返回这些节点的订阅内容"""
+        snapshot = cls.get_topology_snapshot()
+        # NOTE 用户自己占用的节点就算关了也能看到，不在快照里
+        missing = {
+            node.id: node._get_topology_entry()
+            for node in cls.objects.filter(
+                id__in=[i for i in node_ids if i not in snapshot]
+            )
+            .select_related("ss_config", "trojan_config")
+            .prefetch_related("relay_rules__relay_node")
+        }
+        return [snapshot.get(i) or missing[i] for i in node_ids]
+
+    @classmethod
+    def gen_shadowrocket_sub_link(cls, endpoint, password):
+        host, port, udp = endpoint["host"], endpoint["port"], endpoint["udp"]
+        if endpoint["node_type"] == cls.NODE_TYPE_SS:
+            code = f"{endpoint['method']}:{password}@{host}:{port}"
             b64_code = base64.urlsafe_b64encode(code.encode()).decode()
-        elif self.node_type == self.NODE_TYPE_TROJAN:
-            code = f"{user.proxy_password}@{host}:{port}?allowInsecure=1&udp={udp}"
+        elif endpoint["node_type"] == cls.NODE_TYPE_TROJAN:
+            code = f"{password}@{host}:{port}?allowInsecure=1&udp={udp}"
             b64_code = code  # trojan don't need base64 encode
-        return f"{self.node_type}://{b64_code}#{quote(remark)}"
-
-    def get_user_clash_config(self, user, relay_rule=None):
-        if relay_rule:
-            host = relay_rule.relay_host
-            port = relay_rule.relay_port
-            remark = relay_rule.name
-            udp = relay_rule.enable_udp and self.enable_udp
-        else:
-            host = self.server
-            remark = self.remark
-            udp = self.enable_udp
-            port = self.get_user_port()
+        return f"{endpoint['node_type']}://{b64_code}#{quote(endpoint['remark'])}"
 
+    @classmethod
+    def gen_clash_config(cls, endpoint, password):
         config = {
-            "name": remark,
-            "type": self.node_type,
-            "server": host,
-            "password": user.proxy_password,
-            "udp": udp,
-            "port": port,
+            "name": endpoint["remark"],
+            "type": endpoint["node_type"],
+            "server": endpoint["host"],
+            "password": password,
+            "udp": endpoint["udp"],
+            "port": endpoint["port"],
         }
-        if self.node_type == self.NODE_TYPE_SS:
-            config["cipher"] = self.ss_config.method
-        if self.node_type == self.NODE_TYPE_TROJAN:
+        if endpoint["node_type"] == cls.NODE_TYPE_SS:
+            config["cipher"] = endpoint["method"]
+        if endpoint["node_type"] == cls.NODE_TYPE_TROJAN:
             config["skip-cert-verify"] = True
 
         return json.dumps(config, ensure_ascii=False)
@@ -559,19 +722,10 @@ class SSConfig(models.Model, resetPortMixin):
         configs.update(node.get_ehco_server_config())
         return configs
 
-    def to_user_config(self, node: ProxyNode, user: User):
-        have_shared_traffic = user.total_traffic > (
-            user.download_traffic + user.upload_traffic
-        )
-        have_oc_traffic = False
-        if node.have_oc_users:
-            oc = UserProxyNodeOccupancy.get_by_proxy_node_and_user(node, user)
-            if oc:
-                have_oc_traffic = not oc.out_of_usage()
-        enable = node.enable and (have_shared_traffic or have_oc_traffic)
+    def to_user_config(self, user_id: int, password: str, enable: bool):
         return {
-            "user_id": user.id,
-            "password": user.proxy_password,
+            "user_id": user_id,
+            "password": password,
             "enable": enable,
             "method": self.method,
             "protocol": ProxyNode.NODE_TYPE_SS,
@@ -619,20 +773,10 @@ class TrojanConfig(models.Model, resetPortMixin):
         configs.update(node.get_ehco_server_config())
         return configs
 
-    def to_user_config(self, node: ProxyNode, user: User):
-        have_shared_traffic = user.total_traffic > (
-            user.download_traffic + user.upload_traffic
-        )
-        have_oc_traffic = False
-        if node.have_oc_users:
-            oc = UserProxyNodeOccupancy.get_by_proxy_node_and_user(node, user)
-            if oc:
-                have_oc_traffic = not oc.out_of_usage()
-        enable = node.enable and (have_shared_traffic or have_oc_traffic)
-
+    def to_user_config(self, user_id: int, password: str, enable: bool):
         return {
-            "user_id": user.id,
-            "password": user.proxy_password,
+            "user_id": user_id,
+            "password": password,
             "enable": enable,
             "protocol": ProxyNode.NODE_TYPE_TROJAN,
         }
@@ -674,6 +818,28 @@ class RelayNode(BaseNodeModel):
     def __str__(self) -> str:
         return f"{self.name}-{self.remark}" if self.remark else self.name
 
+    @classmethod
+    def get_config_version(cls, node_id) -> str:
+        return version.get_topology_version()
+
+    @classmethod
+    def get_config_version_keys(cls, node_id) -> list:
+        return [version.TOPOLOGY_KEY]
+
+    @classmethod
+    def get_config_snapshot(cls, node_id):
+        """返回序列化好的中转配置(bytes)，按拓扑版本号缓存"""
+        config_version = cls.get_config_version(node_id)
+        key = f"relay_node.config_snapshot.{node_id}.{config_version}"
+        snapshot = cache.get(key)
+        if snapshot is None:
+            node = cls.get_or_none(node_id)
+            if not node:
+                return None
+            snapshot = json.dumps(node.get_config(), cls=DjangoJSONEncoder).encode()
+            cache.set(key, snapshot, c.CACHE_TTL_HOUR)
+        return snapshot
+
     def get_config(self):
         relay_configs = []
         rules = self.relay_rules.prefetch_related("proxy_nodes")
@@ -777,14 +943,55 @@ class RelayRule(BaseModel):
         return self.relay_node.enable_udp
 
 
+def _traffic_cache_tag(date, user_id=None, proxy_node_id=None):
+    if user_id:
+        return f"traffic_rollup.user.{user_id}.{date}"
+    if proxy_node_id:
+        return f"traffic_rollup.node.{proxy_node_id}.{date}"
+    return f"traffic_rollup.{date}"
+
+
+def _traffic_cache_tags(cls, dt, user_id=None, proxy_node_id=None):
+    """按用户/节点和日期打 tag，某个用户的流量变了只删这个用户的缓存"""
+    date = dt.date()
+    if not user_id and not proxy_node_id:
+        return [_traffic_cache_tag(date)]
+    tags = []
+    if user_id:
+        tags.append(_traffic_cache_tag(date, user_id=user_id))
+    if proxy_node_id:
+        tags.append(_traffic_cache_tag(date, proxy_node_id=proxy_node_id))
+    return tags
+
+
 class UserTrafficLog(BaseLogModel):
+    """
+    NOTE 在 mysql 上这张表按 created_at(UTC) 每天一个分区
+    分区表不支持外键，主键也必须包含分区字段，所以外键不建约束，主键是 (id, created_at)
+    分区 pYYYYMMDD 存放当天的数据，p_max 兜底，过期的数据直接 DROP PARTITION
+    """
+
+    PARTITION_PREFIX = "p"
+    PARTITION_MAX = "p_max"
+    PARTITION_DAYS_AHEAD = 3
+
+    # NOTE 流量图表的时间粒度
+    GRANULARITY_DAY = "day"
+    GRANULARITY_HOUR = "hour"
+    GRANULARITIES = (GRANULARITY_DAY, GRANULARITY_HOUR)
+
     user = models.ForeignKey(
-        User, on_delete=models.CASCADE, verbose_name="用户", null=True
+        User,
+        on_delete=models.CASCADE,
+        verbose_name="用户",
+        null=True,
+        db_constraint=False,
     )
     proxy_node = models.ForeignKey(
         ProxyNode,
         on_delete=models.CASCADE,
         verbose_name="代理节点",
+        db_constraint=False,
     )
     upload_traffic = models.BigIntegerField("上传流量", default=0)
     download_traffic = models.BigIntegerField("下载流量", default=0)
@@ -800,64 +1007,126 @@ class UserTrafficLog(BaseLogModel):
         return f"用户流量记录:{self.id}"
 
     @classmethod
-    def get_all_node_online_user_count(cls):
-        now = utils.get_current_datetime()
+    def partition_enabled(cls):
+        """
+        表真的分过区才走删分区的逻辑
+
+        NOTE 0031 迁移被 --fake 或者跳过了的话表还是普通表，不能只看数据库类型
+        """
+        if connection.vendor != "mysql":
+            return False
+        return cls.PARTITION_MAX in cls._get_partition_names()
+
+    @classmethod
+    def _partition_name(cls, date):
+        return f"{cls.PARTITION_PREFIX}{date:%Y%m%d}"
+
+    @classmethod
+    def _partition_sql(cls, date):
+        """分区 date 存放 date 当天的数据"""
         return (
-            cls.objects.filter(
-                created_at__range=[now.subtract(seconds=c.NODE_TIME_OUT), now]
+            f"PARTITION {cls._partition_name(date)} "
+            f"VALUES LESS THAN (TO_DAYS('{date.add(days=1):%Y-%m-%d}'))"
+        )
+
+    @classmethod
+    def _get_partition_names(cls):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                "AND PARTITION_NAME IS NOT NULL",
+                [cls._meta.db_table],
             )
-            .values("user")
-            .count()
+            return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def _get_partition_dates(cls):
+        return sorted(
+            pendulum.from_format(name[len(cls.PARTITION_PREFIX) :], "YYYYMMDD").date()
+            for name in cls._get_partition_names()
+            if name != cls.PARTITION_MAX
         )
 
+    @classmethod
+    def ensure_partitions(cls, days_ahead=PARTITION_DAYS_AHEAD):
+        """提前建好未来几天的分区，从 p_max 里拆出来，p_max 是空的所以很快"""
+        dates = cls._get_partition_dates()
+        today = pendulum.now("UTC").date()
+        date = dates[-1].add(days=1) if dates else today
+        new_dates = []
+        while date <= today.add(days=days_ahead):
+            new_dates.append(date)
+            date = date.add(days=1)
+        if not new_dates:
+            return []
+        partitions = ", ".join(cls._partition_sql(date) for date in new_dates)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"ALTER TABLE {cls._meta.db_table} "
+                f"REORGANIZE PARTITION {cls.PARTITION_MAX} INTO ({partitions}, "
+                f"PARTITION {cls.PARTITION_MAX} VALUES LESS THAN MAXVALUE)"
+            )
+        return new_dates
+
+    @classmethod
+    def drop_expired_partitions(cls, retention_days):
+        """删掉整天都过期的分区，不管数据量多大都是 O(1)"""
+        cutoff = pendulum.now("UTC").subtract(days=retention_days).date()
+        expired = [date for date in cls._get_partition_dates() if date < cutoff]
+        if not expired:
+            return []
+        names = ", ".join(cls._partition_name(date) for date in expired)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {cls._meta.db_table} DROP PARTITION {names}")
+        return expired
+
+    @classmethod
+    def get_all_node_online_user_count(cls):
+        """NOTE 在线状态从 redis 的 presence 里读，不查流量记录"""
+        return presence.get_online_user_count(c.NODE_TIME_OUT)
+
     @classmethod
     def get_latest_online_log_info(cls, proxy_node):
-        now = utils.get_current_datetime()
-        query = cls.objects.filter(
-            proxy_node=proxy_node,
-            created_at__range=[now.subtract(seconds=c.NODE_TIME_OUT), now],
-        )
-        data = {"online_user_count": 0, "online": query.exists()}
+        data = {
+            "online_user_count": 0,
+            "online": presence.is_node_online(proxy_node.id, c.NODE_TIME_OUT),
+        }
         if data["online"]:
-            data["online_user_count"] = (
-                query.filter(user__isnull=False).values("user").distinct().count()
+            data["online_user_count"] = presence.get_node_online_user_count(
+                proxy_node.id, c.NODE_TIME_OUT
             )
         return data
 
     @classmethod
     def calc_user_total_traffic(cls, proxy_node, user_id):
-        logs = cls.objects.filter(user_id=user_id, proxy_node=proxy_node)
-        aggs = logs.aggregate(
-            u=models.Sum("upload_traffic"), d=models.Sum("download_traffic")
-        )
+        """当月的流量，从按天汇总的表里读"""
+        month_start = utils.get_current_datetime().start_of("month").date()
+        aggs = UserTrafficDailyRollup.objects.filter(
+            user_id=user_id, proxy_node=proxy_node, bucket__gte=month_start
+        ).aggregate(u=models.Sum("upload_traffic"), d=models.Sum("download_traffic"))
         ut = aggs["u"] or 0
         dt = aggs["d"] or 0
         return utils.traffic_format(ut + dt)
 
     @classmethod
-    @cache.cached(ttl=c.CACHE_TTL_MONTH)
-    def _get_active_user_count_by_datetime(cls, dt: pendulum.DateTime):
-        qs = (
-            cls.objects.filter(created_at__range=[dt.start_of("day"), dt.end_of("day")])
-            .values("user_id")
-            .distinct()
-        )
-        return qs.count()
-
-    @classmethod
-    def get_active_user_count_by_datetime(cls, dt: pendulum.DateTime):
-        """获取指定日期的活跃用户数量,只有今天的数据会hit db"""
-        today = utils.get_current_datetime()
-        if dt.date() == today.date():
-            return cls._get_active_user_count_by_datetime.uncached(cls, dt)
-        return cls._get_active_user_count_by_datetime(dt.start_of("day"))
+    def drop_traffic_cache(cls, dates, user_ids=(), proxy_node_ids=()):
+        """汇总表重算之后删掉这几天里这些用户/节点的缓存，全站的缓存也要删"""
+        tags = []
+        for date in dates:
+            tags.append(_traffic_cache_tag(date))
+            tags += [_traffic_cache_tag(date, user_id=uid) for uid in user_ids]
+            tags += [
+                _traffic_cache_tag(date, proxy_node_id=nid) for nid in proxy_node_ids
+            ]
+        if not tags:
+            return 0
+        return cache.delete_tags(*tags)
 
     @classmethod
-    @cache.cached(ttl=c.CACHE_TTL_MONTH)
+    @cache.cached(ttl=c.CACHE_TTL_MONTH, lock=True, tags=_traffic_cache_tags)
     def _calc_traffic_by_datetime(cls, date, user_id=None, proxy_node_id=None):
-        qs = cls.objects.filter(
-            created_at__range=[date.start_of("day"), date.end_of("day")]
-        )
+        qs = UserTrafficDailyRollup.objects.filter(bucket=date.date())
         if user_id:
             qs = qs.filter(user_id=user_id)
         if proxy_node_id:
@@ -870,28 +1139,220 @@ class UserTrafficLog(BaseLogModel):
         return round((ut + dt) / settings.GB, 2)
 
     @classmethod
-    def calc_traffic_by_datetime(
-        cls, dt: pendulum.DateTime, user_id=None, proxy_node=None
-    ):
-        """获取指定日期指定用户的流量,只有今天的数据会hit db"""
-        if dt.date() == utils.get_current_datetime().date():
-            return cls._calc_traffic_by_datetime.uncached(
-                cls,
-                dt,
-                user_id,
-                proxy_node.id if proxy_node else None,
+    def _calc_traffic_by_dates(cls, args_list):
+        """
+        _calc_traffic_by_datetime.get_many 没命中的日期用一个 GROUP BY 查出来
+        NOTE args_list 里的 user_id/proxy_node_id 都是一样的
+        """
+        _, _, user_id, proxy_node_id = args_list[0]
+        dates = [args[1].date() for args in args_list]
+        qs = UserTrafficDailyRollup.objects.filter(bucket__in=dates)
+        if user_id:
+            qs = qs.filter(user_id=user_id)
+        if proxy_node_id:
+            qs = qs.filter(proxy_node_id=proxy_node_id)
+        traffic = {
+            row["bucket"]: row["u"] + row["d"]
+            for row in qs.values("bucket").annotate(
+                u=models.Sum("upload_traffic"), d=models.Sum("download_traffic")
             )
-        return cls._calc_traffic_by_datetime(
-            dt.start_of("day"),
-            user_id,
-            proxy_node.id if proxy_node else None,
+        }
+        return [round(traffic.get(date, 0) / settings.GB, 2) for date in dates]
+
+    @classmethod
+    def calc_traffic_by_datetime_list(cls, dt_list, user_id=None, proxy_node=None):
+        """
+        批量获取多天的流量，每天按流量汇总表计算
+        缓存一次 MGET，没命中的日期一次查出来，今天的数据不走缓存
+        """
+        proxy_node_id = proxy_node.id if proxy_node else None
+        today = utils.get_current_datetime().date()
+        cached = cls._calc_traffic_by_datetime.get_many(
+            [
+                (cls, dt.start_of("day"), user_id, proxy_node_id)
+                for dt in dt_list
+                if dt.date() != today
+            ],
+            compute=cls._calc_traffic_by_dates,
         )
+        cached = iter(cached)
+        return [
+            cls._calc_traffic_by_datetime.uncached(cls, dt, user_id, proxy_node_id)
+            if dt.date() == today
+            else next(cached)
+            for dt in dt_list
+        ]
+
+    @classmethod
+    def get_traffic_series(
+        cls, start, end, granularity="day", user_id=None, proxy_node=None
+    ):
+        """
+        [start, end] 之间每天/每小时的流量(GB)，返回 (时间点列表, 流量列表)
+
+        按天走 calc_traffic_by_datetime_list(缓存一次 MGET + 没命中的一次 GROUP BY)
+        按小时从小时汇总表一次 GROUP BY 查出来，查询次数和时间点数量无关
+        """
+        if start > end:
+            return [], []
+        if granularity == cls.GRANULARITY_DAY:
+            dt_list = list(pendulum.interval(start.start_of("day"), end).range("days"))
+            return dt_list, cls.calc_traffic_by_datetime_list(
+                dt_list, user_id, proxy_node
+            )
+        dt_list = list(pendulum.interval(start.start_of("hour"), end).range("hours"))
+        qs = UserTrafficHourlyRollup.objects.filter(bucket__range=[dt_list[0], end])
+        if user_id:
+            qs = qs.filter(user_id=user_id)
+        if proxy_node:
+            qs = qs.filter(proxy_node=proxy_node)
+        traffic = {
+            row["bucket"].timestamp(): row["u"] + row["d"]
+            for row in qs.values("bucket").annotate(
+                u=models.Sum("upload_traffic"), d=models.Sum("download_traffic")
+            )
+        }
+        return dt_list, [
+            round(traffic.get(dt.timestamp(), 0) / settings.GB, 3) for dt in dt_list
+        ]
 
     @property
     def total_traffic(self):
         return utils.traffic_format(self.download_traffic + self.upload_traffic)
 
 
+class BaseTrafficRollup(BaseModel):
+    """
+    按时间段汇总的用户流量，key: (user, proxy_node, bucket)
+
+    统计类的查询都读这里，开销不会随着原始流量记录变多而变大
+    只保存有用户的记录，节点在线的空记录不会汇总进来
+    """
+
+    UNIQUE_FIELDS = ["user", "proxy_node", "bucket"]
+    UPDATE_FIELDS = ["upload_traffic", "download_traffic"]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="用户")
+    proxy_node = models.ForeignKey(
+        ProxyNode, on_delete=models.CASCADE, verbose_name="代理节点"
+    )
+    upload_traffic = models.BigIntegerField("上传流量", default=0)
+    download_traffic = models.BigIntegerField("下载流量", default=0)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def _upsert(cls, rows: List[dict]):
+        """重新计算出来的值直接覆盖旧值，重复跑是幂等的"""
+        # NOTE mysql 不支持指定冲突的字段，靠唯一索引判断
+        unique_fields = (
+            cls.UNIQUE_FIELDS
+            if connection.features.supports_update_conflicts_with_target
+            else None
+        )
+        cls.objects.bulk_create(
+            [
+                cls(
+                    user_id=row["user_id"],
+                    proxy_node_id=row["proxy_node_id"],
+                    bucket=row["bucket"],
+                    upload_traffic=row["u"] or 0,
+                    download_traffic=row["d"] or 0,
+                )
+                for row in rows
+            ],
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=cls.UPDATE_FIELDS,
+        )
+        return len(rows)
+
+
+class UserTrafficHourlyRollup(BaseTrafficRollup):
+    # NOTE 汇总进度，下次从这个小时开始重新汇总
+    WATERMARK_KEY = "traffic_rollup.watermark"
+
+    bucket = models.DateTimeField("小时", db_index=True)
+
+    class Meta:
+        verbose_name = "用户流量小时汇总"
+        verbose_name_plural = "用户流量小时汇总"
+        unique_together = ["user", "proxy_node", "bucket"]
+
+    @classmethod
+    def get_watermark(cls):
+        """上次汇总到的小时，redis 里没有时用汇总表里最新的小时，都没有返回 None"""
+        if value := redis.get(cls.WATERMARK_KEY):
+            return pendulum.from_timestamp(int(value))
+        if bucket := cls.objects.aggregate(bucket=models.Max("bucket"))["bucket"]:
+            return pendulum.instance(bucket)
+        return None
+
+    @classmethod
+    def set_watermark(cls, dt: pendulum.DateTime):
+        redis.set(cls.WATERMARK_KEY, int(dt.timestamp()))
+
+    @classmethod
+    def rollup(cls, start: pendulum.DateTime):
+        """从原始记录重新汇总 start 所在小时到现在的数据"""
+        # NOTE 按 UTC 截断到小时，和本地时区的整点是一样的，还能避免 mysql 的 CONVERT_TZ
+        rows = (
+            UserTrafficLog.objects.filter(
+                created_at__gte=start.start_of("hour"), user__isnull=False
+            )
+            .annotate(bucket=TruncHour("created_at", tzinfo=dt_timezone.utc))
+            .values("user_id", "proxy_node_id", "bucket")
+            .annotate(u=models.Sum("upload_traffic"), d=models.Sum("download_traffic"))
+            .order_by()
+        )
+        return cls._upsert(list(rows))
+
+
+class UserTrafficDailyRollup(BaseTrafficRollup):
+    bucket = models.DateField("日期", db_index=True)
+
+    class Meta:
+        verbose_name = "用户流量每日汇总"
+        verbose_name_plural = "用户流量每日汇总"
+        unique_together = ["user", "proxy_node", "bucket"]
+
+    @classmethod
+    def rollup(cls, dt: pendulum.DateTime):
+        """从小时汇总重新汇总 dt 当天的数据"""
+        rows = (
+            UserTrafficHourlyRollup.objects.filter(
+                bucket__range=[dt.start_of("day"), dt.end_of("day")]
+            )
+            .values("user_id", "proxy_node_id")
+            .annotate(u=models.Sum("upload_traffic"), d=models.Sum("download_traffic"))
+            .order_by()
+        )
+        return cls._upsert([dict(row, bucket=dt.date()) for row in rows])
+
+
+class TrafficBufferFlushLog(BaseLogModel):
+    """
+    缓冲的流量每一批写入数据库的记录，和流量在同一个事务里写入
+
+    写入成功但是删掉 redis 里这一批之前挂了的话，下次还会读到同一批，
+    有记录就不会再写一遍
+    """
+
+    flush_id = models.CharField("批次", max_length=32, unique=True)
+
+    class Meta:
+        verbose_name = "流量缓冲刷入记录"
+        verbose_name_plural = "流量缓冲刷入记录"
+
+    @classmethod
+    def record(cls, flush_id: str) -> bool:
+        """记录这一批，已经记录过时返回 False，要在写入流量的事务里调用"""
+        _, created = cls.objects.get_or_create(flush_id=flush_id)
+        return created
+
+
 class OccupancyConfig(BaseModel):
     STATUS_ACTIVE = "active"
     STATUS_NORMAL = "normal"
@@ -932,44 +1393,47 @@ class OccupancyConfig(BaseModel):
 
     @classmethod
     def get_purchasable_proxy_nodes(cls, user: User):
-        # 1. get all proxy nodes that have occupancy config
-        query = cls.objects.filter(occupancy_user_limit__gt=0)
-        # 2. filter out nodes that has been occupied by other users
-        occupied_node_ids = UserProxyNodeOccupancy.get_occupied_node_ids()
-        not_occupied_node_ids = query.exclude(
-            proxy_node_id__in=occupied_node_ids
-        ).values("proxy_node_id")
-        # 3. add nodes that has been occupied by user but not exceed limit
-        not_reach_limit_node_ids = []
-        for node_query in occupied_node_ids:
-            node_id = node_query["proxy_node_id"]
-            cfg = cls.objects.get(proxy_node_id=node_id)
-            if not cfg.reach_limit(user):
-                not_reach_limit_node_ids.append(node_id)
-        return ProxyNode.objects.filter(id__in=not_occupied_node_ids).select_related(
-            "occupancy_config"
-        ) | ProxyNode.objects.filter(id__in=not_reach_limit_node_ids).select_related(
-            "occupancy_config"
+        """
+        一条 GROUP BY 查询算出用户能购买/续费的节点
+        1. 配置了占用的节点，有效占用人数没到上限
+        2. 用户自己占用的节点，不管有没有到上限都可以续费
+        """
+        valid = Q(
+            userproxynodeoccupancy__end_time__gt=utils.get_current_datetime(),
+            userproxynodeoccupancy__used_traffic__lt=F(
+                "userproxynodeoccupancy__total_traffic"
+            ),
+        )
+        return (
+            ProxyNode.objects.filter(occupancy_config__occupancy_user_limit__gt=0)
+            .annotate(
+                occupied_count=models.Count("userproxynodeoccupancy", filter=valid),
+                user_occupied_count=models.Count(
+                    "userproxynodeoccupancy",
+                    filter=valid & Q(userproxynodeoccupancy__user=user),
+                ),
+            )
+            .filter(
+                Q(occupied_count__lt=F("occupancy_config__occupancy_user_limit"))
+                | Q(user_occupied_count__gt=0)
+            )
+            .select_related("occupancy_config")
         )
 
     def reach_limit(self, user: User):
-        node = self.proxy_node
         # 1. check if node has been occupied by user, if yes, return False because user can occupy same node multiple times
-        node_user_ids = [
-            i["user_id"]
-            for i in UserProxyNodeOccupancy.get_node_occupancy_user_ids(node)
-        ]
+        node_user_ids = UserProxyNodeOccupancy.get_node_occupancy_user_ids(
+            self.proxy_node_id
+        )
         if user.id in node_user_ids:
             return False
         else:
             return len(node_user_ids) >= self.occupancy_user_limit
 
     def active_user_count(self):
-        node_user_ids = [
-            i["user_id"]
-            for i in UserProxyNodeOccupancy.get_node_occupancy_user_ids(self.proxy_node)
-        ]
-        return len(node_user_ids)
+        return len(
+            UserProxyNodeOccupancy.get_node_occupancy_user_ids(self.proxy_node_id)
+        )
 
     @property
     def human_occupancy_traffic(self):
@@ -982,6 +1446,8 @@ class OccupancyConfig(BaseModel):
 
 
 class UserProxyNodeOccupancy(BaseModel):
+    EXPIRE_WATERMARK_KEY = "occupancy.expire_watermark"
+
     user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="用户")
     proxy_node = models.ForeignKey(
         ProxyNode, on_delete=models.CASCADE, verbose_name="代理节点"
@@ -993,6 +1459,18 @@ class UserProxyNodeOccupancy(BaseModel):
     used_traffic = models.BigIntegerField("已用流量(单位字节)", default=0)
     total_traffic = models.BigIntegerField("总流量(单位字节)", default=settings.GB)
 
+    # NOTE used_traffic 只改流量的保存不更新占用版本，缓存里会过时，不放进占用表，
+    # 要用的时候查库。流量用完时会更新版本，占用表里的记录本身不会过时
+    OCCUPANCY_MAP_FIELDS = (
+        "id",
+        "proxy_node_id",
+        "user_id",
+        "total_traffic",
+        "end_time",
+    )
+    # NOTE 进程内的占用表 (占用版本, 占用表)
+    _occupancy_map = None
+
     class Meta:
         verbose_name = "用户占用记录"
         verbose_name_plural = "用户占用记录"
@@ -1019,10 +1497,10 @@ class UserProxyNodeOccupancy(BaseModel):
         if occupancy_config.occupancy_user_limit <= 0:
             raise Exception("not allow to create occupancy record with user limit 0")
         if occupancy_config.occupancy_user_limit > 0:
-            node_user_ids = [
-                i["user_id"]
-                for i in UserProxyNodeOccupancy.get_node_occupancy_user_ids(node)
-            ]
+            # NOTE 写操作直接查库，不用缓存的占用表
+            node_user_ids = list(
+                cls.get_node_occupancies(node).values_list("user_id", flat=True)
+            )
             if cls.get_node_occupancies(
                 node
             ).count() >= occupancy_config.occupancy_user_limit and (
@@ -1061,13 +1539,42 @@ class UserProxyNodeOccupancy(BaseModel):
             )
 
     @classmethod
-    def get_occupied_node_ids(cls):
-        occupied_node_ids = cls._valid_occupancy_query().values("proxy_node_id")
-        return occupied_node_ids
+    def get_occupancy_map(cls):
+        """
+        所有有效的占用记录 NOTE key: node_id value: {user_id: 占用记录(values)}
+
+        先读进程内存再读 redis，最后才查库，按占用版本失效
+        占用记录变动/流量用完/到期都会更新占用版本
+        """
+        # NOTE 先读版本再查库，查库之后的变动也会更新版本
+        occupancy_version = version.get_occupancy_version()
+        if cls._occupancy_map and cls._occupancy_map[0] == occupancy_version:
+            return cls._occupancy_map[1]
+        key = f"occupancy_map.{occupancy_version}"
+        # NOTE 里面有 int 做 key 和 datetime，只能用 pickle
+        occupancy_map = cache.get(key, serializer="pickle")
+        if occupancy_map is None:
+            occupancy_map = {}
+            for o in cls._valid_occupancy_query().values(*cls.OCCUPANCY_MAP_FIELDS):
+                occupancy_map.setdefault(o["proxy_node_id"], {})[o["user_id"]] = o
+            cache.set(key, occupancy_map, ttl=c.CACHE_TTL_HOUR, serializer="pickle")
+        cls._occupancy_map = (occupancy_version, occupancy_map)
+        return occupancy_map
 
     @classmethod
-    def get_node_occupancy_user_ids(cls, node: ProxyNode):
-        return cls._valid_occupancy_query().filter(proxy_node=node).values("user_id")
+    def get_node_occupancy_map(cls, node_id: int):
+        """NOTE key: user_id value: 有效的占用记录(values)"""
+        # NOTE 到期是定时任务更新的版本，会晚一点，这里再按时间过滤一下
+        now = utils.get_current_datetime()
+        return {
+            user_id: o
+            for user_id, o in cls.get_occupancy_map().get(node_id, {}).items()
+            if o["end_time"] > now
+        }
+
+    @classmethod
+    def get_node_occupancy_user_ids(cls, node_id: int) -> List[int]:
+        return list(cls.get_node_occupancy_map(node_id))
 
     @classmethod
     def get_user_occupied_node_ids(cls, user: User):
@@ -1083,9 +1590,45 @@ class UserProxyNodeOccupancy(BaseModel):
 
     @classmethod
     def check_and_incr_traffic(cls, user_id, proxy_node_id, traffic):
-        r = cls.objects.get(user__id=user_id, proxy_node__id=proxy_node_id)
-        r.used_traffic += traffic
-        r.save()
+        query = cls.objects.filter(user_id=user_id, proxy_node_id=proxy_node_id)
+        r = query.get()
+        out_of_usage = r.out_of_usage()
+        # NOTE 用 F() 原子地加上去，并发上报时不会互相覆盖
+        query.update(used_traffic=F("used_traffic") + traffic)
+        r.refresh_from_db(fields=["used_traffic"])
+        if not out_of_usage and r.out_of_usage():
+            # 流量用完了，通知节点更新配置
+            version.touch_proxy_node(proxy_node_id)
+
+    @classmethod
+    def get_expire_watermark(cls):
+        """上次检查到期检查到的时间，没有时返回 None"""
+        if value := redis.get(cls.EXPIRE_WATERMARK_KEY):
+            return pendulum.from_timestamp(float(value))
+        return None
+
+    @classmethod
+    def set_expire_watermark(cls, dt: pendulum.DateTime):
+        redis.set(cls.EXPIRE_WATERMARK_KEY, dt.timestamp())
+
+    @classmethod
+    def touch_expired_occupancy_nodes(cls, seconds=60 * 2):
+        """
+        到期的占用记录不会触发写操作，需要定时通知节点更新配置
+
+        NOTE 从上次检查到的时间开始找，定时任务晚跑、停过或者失败了也不会漏掉，
+        第一次跑没有记录时往前找 seconds 秒
+        """
+        now = utils.get_current_datetime()
+        since = cls.get_expire_watermark() or now.subtract(seconds=seconds)
+        node_ids = set(
+            cls.objects.filter(end_time__gt=since, end_time__lte=now).values_list(
+                "proxy_node_id", flat=True
+            )
+        )
+        for node_id in node_ids:
+            version.touch_proxy_node(node_id)
+        cls.set_expire_watermark(now)
 
     @classmethod
     def get_user_occupancies(cls, user: User, out_of_usage=False, limit=None):
@@ -1131,3 +1674,69 @@ class UserProxyNodeOccupancy(BaseModel):
             self.used_traffic >= self.total_traffic
             or self.end_time < utils.get_current_datetime()
         )
+
+
+def _on_commit(func, *args):
+    transaction.on_commit(lambda: func(*args))
+
+
+def _only_update_fields(kw, fields):
+    update_fields = kw.get("update_fields")
+    return bool(update_fields) and set(update_fields) <= set(fields)
+
+
+def _touch_topology(sender, instance, **kw):
+    if sender is ProxyNode and _only_update_fields(kw, ProxyNode.TRAFFIC_FIELDS):
+        return
+    if sender is RelayRule and _only_update_fields(kw, ["up_traffic", "down_traffic"]):
+        return
+    _on_commit(version.touch_topology)
+
+
+def _touch_relay_rule_proxy_nodes(sender, instance, action, **kw):
+    if action in ("post_add", "post_remove", "post_clear"):
+        _on_commit(version.touch_topology)
+
+
+def _get_user_config_state(user):
+    """影响节点用户配置的用户状态，相关字段没有加载时返回 None"""
+    if user.get_deferred_fields() & {*ProxyNode.USER_CONFIG_FIELDS, "level"}:
+        return None
+    have_traffic = user.total_traffic > user.upload_traffic + user.download_traffic
+    return user.proxy_password, user.level, have_traffic
+
+
+def _snapshot_user_config_state(sender, instance, **kw):
+    instance._config_state = _get_user_config_state(instance)
+
+
+def _touch_users(sender, instance, created=False, **kw):
+    # NOTE 签到、下单、后台编辑之类的保存不影响节点配置，状态没变时不更新版本号
+    state = _get_user_config_state(instance)
+    if not created and state is not None:
+        if state == getattr(instance, "_config_state", None):
+            return
+    instance._config_state = state
+    _on_commit(version.touch_users)
+
+
+def _touch_users_on_delete(sender, instance, **kw):
+    _on_commit(version.touch_users)
+
+
+def _touch_occupancy_node(sender, instance, **kw):
+    if _only_update_fields(kw, ["used_traffic"]):
+        return
+    _on_commit(version.touch_proxy_node, instance.proxy_node_id)
+
+
+# NOTE 节点配置相关的数据变动时更新版本号，节点拉配置时可以用版本号判断是否有变化
+for sender in (ProxyNode, SSConfig, TrojanConfig, RelayNode, RelayRule):
+    post_save.connect(_touch_topology, sender=sender)
+    post_delete.connect(_touch_topology, sender=sender)
+m2m_changed.connect(_touch_relay_rule_proxy_nodes, sender=RelayRule.proxy_nodes.through)
+post_init.connect(_snapshot_user_config_state, sender=User)
+post_save.connect(_touch_users, sender=User)
+post_delete.connect(_touch_users_on_delete, sender=User)
+post_save.connect(_touch_occupancy_node, sender=UserProxyNodeOccupancy)
+post_delete.connect(_touch_occupancy_node, sender=UserProxyNodeOccupancy)
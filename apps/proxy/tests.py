@@ -0,0 +1,274 @@
+import threading
+import time
+from unittest import mock
+
+import pendulum
+from django.conf import settings
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from apps.proxy.models import (
+    OccupancyConfig,
+    ProxyNode,
+    SSConfig,
+    UserProxyNodeOccupancy,
+    UserTrafficLog,
+)
+from apps.proxy.traffic import apply_node_traffic, bulk_incr
+from apps.sspanel.models import User
+
+
+def run_in_threads(fn, workers):
+    """每个线程用自己的数据库连接跑 fn，线程里的异常在主线程抛出"""
+    errors = []
+
+    def target():
+        try:
+            fn()
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=target) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+class TrafficConcurrencyTest(TransactionTestCase):
+    """多个 worker 并发写流量，增量不能丢"""
+
+    WORKERS = 4
+    ROUNDS = 10
+
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f"u{i}", total_traffic=100 * settings.GB)
+            for i in range(3)
+        ]
+        self.node = ProxyNode.objects.create(
+            name="n1", server="1.1.1.1", total_traffic=100 * settings.GB
+        )
+
+    def test_bulk_incr(self):
+        deltas = {user.id: {"upload_traffic": user.id} for user in self.users}
+
+        def work():
+            for _ in range(self.ROUNDS):
+                bulk_incr(User, deltas)
+
+        run_in_threads(work, self.WORKERS)
+        for user in User.objects.filter(id__in=list(deltas)):
+            self.assertEqual(user.upload_traffic, user.id * self.WORKERS * self.ROUNDS)
+
+    def test_apply_node_traffic(self):
+        occupied = self.users[0]
+        UserProxyNodeOccupancy.objects.create(
+            user=occupied,
+            proxy_node=self.node,
+            end_time=pendulum.now().add(days=30),
+            total_traffic=100 * settings.GB,
+        )
+        payload = {
+            self.node.id: {
+                "users": {user.id: [1, 2] for user in self.users},
+                "ip_list": {},
+                "total_traffic": 3 * len(self.users),
+            }
+        }
+
+        def work():
+            for _ in range(self.ROUNDS):
+                apply_node_traffic(payload)
+
+        run_in_threads(work, self.WORKERS)
+        times = self.WORKERS * self.ROUNDS
+        self.node.refresh_from_db()
+        self.assertEqual(self.node.used_traffic, 3 * len(self.users) * times)
+        occupancy = UserProxyNodeOccupancy.objects.get(user=occupied)
+        self.assertEqual(occupancy.used_traffic, 3 * times)
+        for user in User.objects.filter(id__in=[u.id for u in self.users[1:]]):
+            self.assertEqual(user.upload_traffic, 1 * times)
+            self.assertEqual(user.download_traffic, 2 * times)
+        self.assertEqual(
+            UserTrafficLog.objects.filter(proxy_node=self.node).count(),
+            len(self.users) * times,
+        )
+
+
+class ProxyNodeQueryCountTest(TransactionTestCase):
+    """生成节点用户配置的查询次数不能随用户数增长"""
+
+    def setUp(self):
+        self.node = ProxyNode.objects.create(name="n1", server="1.1.1.1")
+        self.ss_config = SSConfig.objects.create(proxy_node=self.node)
+
+    def create_users(self, start, end):
+        for i in range(start, end):
+            User.objects.create_user(f"u{i}")
+
+    def count_queries(self):
+        # NOTE 先跑一次把占用记录的缓存填上，只数生成配置本身的查询
+        self.node.get_user_configs(self.ss_config)
+        with CaptureQueriesContext(connection) as ctx:
+            configs = self.node.get_user_configs(self.ss_config)
+        return len(ctx), configs
+
+    def test_shared_node(self):
+        self.create_users(0, 2)
+        num, configs = self.count_queries()
+        self.assertEqual(len(configs), 2)
+        self.create_users(2, 30)
+        with self.assertNumQueries(num):
+            configs = self.node.get_user_configs(self.ss_config)
+        self.assertEqual(len(configs), 30)
+
+    def test_occupied_node(self):
+        end_time = pendulum.now().add(days=30)
+        self.create_users(0, 30)
+        users = list(User.objects.all())
+        UserProxyNodeOccupancy.objects.create(
+            user=users[0], proxy_node=self.node, end_time=end_time
+        )
+        num, configs = self.count_queries()
+        self.assertEqual(len(configs), 1)
+        for user in users[1:]:
+            UserProxyNodeOccupancy.objects.create(
+                user=user, proxy_node=self.node, end_time=end_time
+            )
+        self.count_queries()
+        with self.assertNumQueries(num):
+            configs = self.node.get_user_configs(self.ss_config)
+        self.assertEqual(len(configs), 30)
+
+
+class OccupancyConfigQueryCountTest(TransactionTestCase):
+    """可购买的节点一条查询算出来，查询次数不能随节点数增长"""
+
+    def setUp(self):
+        self.user = User.objects.create_user("buyer")
+        self.other = User.objects.create_user("other")
+        self.nodes = []
+
+    def create_nodes(self, count):
+        for _ in range(count):
+            node = ProxyNode.objects.create(name="n", server="1.1.1.1")
+            OccupancyConfig.objects.create(
+                proxy_node=node, occupancy_price=1, occupancy_user_limit=1
+            )
+            self.nodes.append(node)
+
+    def occupy(self, user, node):
+        UserProxyNodeOccupancy.objects.create(
+            user=user, proxy_node=node, end_time=pendulum.now().add(days=30)
+        )
+
+    def get_purchasable_node_ids(self):
+        nodes = OccupancyConfig.get_purchasable_proxy_nodes(self.user)
+        return {node.id for node in nodes if node.occupancy_config.occupancy_price}
+
+    def test_purchasable_proxy_nodes(self):
+        self.create_nodes(3)
+        # NOTE 被别人占满的不能买，自己占满的可以续费
+        self.occupy(self.other, self.nodes[0])
+        self.occupy(self.user, self.nodes[1])
+        with self.assertNumQueries(1):
+            node_ids = self.get_purchasable_node_ids()
+        self.assertEqual(node_ids, {node.id for node in self.nodes[1:]})
+
+        self.create_nodes(20)
+        for node in self.nodes[3:13]:
+            self.occupy(self.other, node)
+        with self.assertNumQueries(1):
+            node_ids = self.get_purchasable_node_ids()
+        self.assertEqual(
+            node_ids, {node.id for node in self.nodes[1:3] + self.nodes[13:]}
+        )
+
+
+class ApplyNodeTrafficQueryCountTest(TransactionTestCase):
+    """一批流量写入的语句数不能随节点数增长"""
+
+    def setUp(self):
+        self.user = User.objects.create_user("u", total_traffic=100 * settings.GB)
+        self.nodes = []
+
+    def create_nodes(self, count):
+        for _ in range(count):
+            self.nodes.append(ProxyNode.objects.create(name="n", server="1.1.1.1"))
+
+    def gen_payload(self, traffic=3):
+        return {
+            node.id: {
+                "users": {self.user.id: [1, traffic - 1]},
+                "ip_list": {},
+                "total_traffic": traffic,
+                "u_bandwidth": node.id * 10,
+                "d_bandwidth": node.id * 20,
+            }
+            for node in self.nodes
+        }
+
+    def count_queries(self):
+        apply_node_traffic(self.gen_payload())
+        with CaptureQueriesContext(connection) as ctx:
+            apply_node_traffic(self.gen_payload())
+        return len(ctx)
+
+    def test_apply_node_traffic(self):
+        self.create_nodes(2)
+        num = self.count_queries()
+        self.create_nodes(10)
+        self.assertEqual(self.count_queries(), num)
+        for node in ProxyNode.objects.filter(id__in=[n.id for n in self.nodes]):
+            self.assertEqual(node.current_used_upload_bandwidth_bytes, node.id * 10)
+            self.assertEqual(node.current_used_download_bandwidth_bytes, node.id * 20)
+
+    def test_disable_overflow_nodes(self):
+        self.create_nodes(3)
+        over = self.nodes[0]
+        ProxyNode.objects.filter(id=over.id).update(total_traffic=settings.GB - 1)
+        apply_node_traffic(self.gen_payload(traffic=settings.GB))
+        enabled = dict(
+            ProxyNode.objects.filter(id__in=[n.id for n in self.nodes]).values_list(
+                "id", "enable"
+            )
+        )
+        self.assertEqual(enabled, {node.id: node.id != over.id for node in self.nodes})
+
+
+class TrafficCacheLockTest(TransactionTestCase):
+    """流量图表的缓存同时没命中时只算一次"""
+
+    def test_concurrent_miss_computes_once(self):
+        user = User.objects.create_user("u")
+        days = [pendulum.now().subtract(days=i).start_of("day") for i in range(1, 8)]
+        for dt in days:
+            UserTrafficLog._calc_traffic_by_datetime.invalidate(
+                UserTrafficLog, dt, user.id, None
+            )
+        calc = UserTrafficLog._calc_traffic_by_dates
+        calls = []
+
+        def slow_calc(args_list):
+            calls.append(args_list)
+            time.sleep(0.2)
+            return calc(args_list)
+
+        results = []
+        with mock.patch.object(
+            UserTrafficLog, "_calc_traffic_by_dates", side_effect=slow_calc
+        ):
+            run_in_threads(
+                lambda: results.append(
+                    UserTrafficLog.calc_traffic_by_datetime_list(days, user.id)
+                ),
+                4,
+            )
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[0] * len(days)] * 4)
@@ -0,0 +1,344 @@
+"""
+节点上报流量的记账
+
+所有流量计数都通过 bulk_incr 用 `UPDATE ... SET x = x + delta` 写入数据库，
+不先读再写，多个节点同时上报时不会丢流量，每张表每批只有一条语句。
+开启缓冲时节点上报只在 redis hash 里用 HINCRBY 累加增量，由定时任务汇总后再写入
+"""
+
+import json
+import uuid
+from collections import defaultdict
+from typing import Dict
+
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+
+from apps import utils
+from apps.ext import lock, redis, version
+from apps.proxy.models import (
+    ProxyNode,
+    RelayNode,
+    RelayRule,
+    TrafficBufferFlushLog,
+    UserProxyNodeOccupancy,
+    UserTrafficLog,
+)
+from apps.sspanel.models import User
+
+BULK_INCR_BATCH_SIZE = 1000
+
+
+def bulk_incr(
+    model,
+    deltas: Dict[int, Dict[str, int]],
+    values: Dict[int, Dict[str, int]] = None,
+    **extra_updates,
+):
+    """
+    一条语句给多行的计数字段加上各自的增量
+
+    deltas: key: pk value: {field: delta}
+    values: key: pk value: {field: value} 直接覆盖的字段，比如当前带宽，和增量在同一条语句里
+    UPDATE table SET field = field + CASE pk WHEN 1 THEN 10 ... ELSE 0 END
+    WHERE pk IN (...)
+    """
+    values = values or {}
+    pks = list(deltas)
+    updated = 0
+    for i in range(0, len(pks), BULK_INCR_BATCH_SIZE):
+        batch = pks[i : i + BULK_INCR_BATCH_SIZE]
+        fields = {field for pk in batch for field in deltas[pk]}
+        updates = dict(extra_updates)
+        for field in fields:
+            whens = [
+                When(pk=pk, then=Value(deltas[pk][field]))
+                for pk in batch
+                if deltas[pk].get(field)
+            ]
+            if whens:
+                updates[field] = F(field) + Case(
+                    *whens, default=Value(0), output_field=models.BigIntegerField()
+                )
+        value_fields = {field for pk in batch for field in values.get(pk, {})}
+        for field in value_fields:
+            whens = [
+                When(pk=pk, then=Value(values[pk][field]))
+                for pk in batch
+                if field in values.get(pk, {})
+            ]
+            updates[field] = Case(
+                *whens, default=F(field), output_field=models.BigIntegerField()
+            )
+        if updates:
+            updated += model.objects.filter(pk__in=batch).update(**updates)
+    return updated
+
+
+class TrafficBuffer:
+    USER_TRAFFIC_KEY = "traffic_buffer.user_traffic"
+    USER_IP_LIST_KEY = "traffic_buffer.user_ip_list"
+    NODE_TRAFFIC_KEY = "traffic_buffer.node_traffic"
+    NODE_BANDWIDTH_KEY = "traffic_buffer.node_bandwidth"
+    RELAY_TRAFFIC_KEY = "traffic_buffer.relay_traffic"
+    KEYS = (
+        USER_TRAFFIC_KEY,
+        USER_IP_LIST_KEY,
+        NODE_TRAFFIC_KEY,
+        NODE_BANDWIDTH_KEY,
+        RELAY_TRAFFIC_KEY,
+    )
+    # NOTE 待刷入的这一批的 id，和待刷入的 key 一起创建、一起删除
+    FLUSH_ID_KEY = "traffic_buffer.flush_id"
+
+    def __init__(self, redis_client) -> None:
+        self._redis_client = redis_client
+
+    @classmethod
+    def _flushing_key(cls, key):
+        return f"{key}.flushing"
+
+    def push(self, node: ProxyNode, data: dict):
+        """节点上报时调用，只写 redis"""
+        report = summarize_node_report(node, data)
+        pipe = self._redis_client.pipeline()
+        for user_id, (u, d) in report["users"].items():
+            pipe.hincrby(self.USER_TRAFFIC_KEY, f"{node.id}:{user_id}:u", u)
+            pipe.hincrby(self.USER_TRAFFIC_KEY, f"{node.id}:{user_id}:d", d)
+        for user_id, ip_list in report["ip_list"].items():
+            pipe.hset(
+                self.USER_IP_LIST_KEY, f"{node.id}:{user_id}", json.dumps(ip_list)
+            )
+        # NOTE 没有用户流量时也要记一下，用来表示节点在线
+        pipe.hincrby(self.NODE_TRAFFIC_KEY, node.id, report["total_traffic"])
+        pipe.hset(self.NODE_BANDWIDTH_KEY, f"{node.id}:u", report["u_bandwidth"])
+        pipe.hset(self.NODE_BANDWIDTH_KEY, f"{node.id}:d", report["d_bandwidth"])
+        pipe.execute()
+
+    def push_relay(self, node: RelayNode, data: list):
+        """中转节点上报时调用，只写 redis"""
+        pipe = self._redis_client.pipeline()
+        for name, (u, d) in summarize_relay_report(node, data).items():
+            pipe.hincrby(self.RELAY_TRAFFIC_KEY, f"{node.id}:{name}:u", u)
+            pipe.hincrby(self.RELAY_TRAFFIC_KEY, f"{node.id}:{name}:d", d)
+        pipe.execute()
+
+    def _take(self):
+        """
+        把缓冲区原子地改名成待刷入的 key 后读出来，返回 (flush_id, 数据)
+
+        上次刷入失败留下的这一批还在时不改名，这次先把上一批刷进去
+        NOTE 在刷入的锁里调用，不会有别的进程同时改这些 key
+        """
+        flush_id = self._redis_client.get(self.FLUSH_ID_KEY)
+        if flush_id is None:
+            flush_id = uuid.uuid4().hex.encode()
+            pipe = self._redis_client.pipeline()
+            for key in self.KEYS:
+                pipe.renamenx(key, self._flushing_key(key))
+            pipe.set(self.FLUSH_ID_KEY, flush_id)
+            pipe.execute(raise_on_error=False)
+
+        pipe = self._redis_client.pipeline(transaction=False)
+        for key in self.KEYS:
+            pipe.hgetall(self._flushing_key(key))
+        return flush_id.decode(), dict(zip(self.KEYS, pipe.execute()))
+
+    def _parse(self, raw: dict):
+        """
+        NOTE nodes key: node_id value: 节点这段时间内的流量汇总
+        relay_nodes key: relay_node_id value: {rule_name: [u, d]}
+        """
+        nodes = defaultdict(
+            lambda: {"users": defaultdict(lambda: [0, 0]), "ip_list": {}}
+        )
+        for field, value in raw[self.USER_TRAFFIC_KEY].items():
+            node_id, user_id, direction = field.decode().split(":")
+            user_traffic = nodes[int(node_id)]["users"][int(user_id)]
+            user_traffic[0 if direction == "u" else 1] += int(value)
+        for field, value in raw[self.USER_IP_LIST_KEY].items():
+            node_id, user_id = field.decode().split(":")
+            nodes[int(node_id)]["ip_list"][int(user_id)] = json.loads(value)
+        for field, value in raw[self.NODE_TRAFFIC_KEY].items():
+            nodes[int(field)]["total_traffic"] = int(value)
+        for field, value in raw[self.NODE_BANDWIDTH_KEY].items():
+            node_id, direction = field.decode().split(":")
+            nodes[int(node_id)][f"{direction}_bandwidth"] = int(value)
+        relay_nodes = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        for field, value in raw[self.RELAY_TRAFFIC_KEY].items():
+            # NOTE 规则名里可能有冒号
+            node_id, rest = field.decode().split(":", 1)
+            name, direction = rest.rsplit(":", 1)
+            relay_nodes[int(node_id)][name][0 if direction == "u" else 1] += int(value)
+        return nodes, relay_nodes
+
+    def flush(self):
+        """定时任务调用，把缓冲区的增量批量写入数据库"""
+        with lock.traffic_buffer_flush_lock():
+            flush_id, raw = self._take()
+            nodes, relay_nodes = self._parse(raw)
+            with transaction.atomic():
+                # NOTE 这一批已经写进去过了，只是上次没来得及删掉
+                if (nodes or relay_nodes) and TrafficBufferFlushLog.record(flush_id):
+                    if nodes:
+                        apply_node_traffic(nodes)
+                    if relay_nodes:
+                        apply_relay_traffic(relay_nodes)
+            self._redis_client.delete(
+                self.FLUSH_ID_KEY, *[self._flushing_key(k) for k in self.KEYS]
+            )
+        return len(nodes) + len(relay_nodes)
+
+
+def summarize_node_report(node: ProxyNode, data: dict):
+    """把节点的一次上报汇总成 apply_node_traffic 需要的格式，流量已经乘上倍率"""
+    users = defaultdict(lambda: [0, 0])
+    ip_list = {}
+    total_traffic = 0
+    for user_data in data.get("data", []):
+        user_id = int(user_data["user_id"])
+        u = int(int(user_data["upload_traffic"]) * node.enlarge_scale)
+        d = int(int(user_data["download_traffic"]) * node.enlarge_scale)
+        users[user_id][0] += u
+        users[user_id][1] += d
+        ip_list[user_id] = user_data.get("ip_list", [])
+        total_traffic += u + d
+    return {
+        "users": users,
+        "ip_list": ip_list,
+        "total_traffic": total_traffic,
+        "u_bandwidth": int(data.get("upload_bandwidth", 0)),
+        "d_bandwidth": int(data.get("download_bandwidth", 0)),
+    }
+
+
+def summarize_relay_report(node: RelayNode, data: list):
+    """把中转节点的一次上报按规则名汇总，流量已经乘上倍率"""
+    rules = defaultdict(lambda: [0, 0])
+    for rule_data in data:
+        stats = rule_data["stats"]
+        rules[rule_data["relay_label"]][0] += int(stats["up"] * node.enlarge_scale)
+        rules[rule_data["relay_label"]][1] += int(stats["down"] * node.enlarge_scale)
+    return rules
+
+
+def apply_relay_traffic(relay_nodes: dict):
+    """
+    把汇总好的中转流量写入数据库，只更新有流量的规则，一条语句写完
+
+    relay_nodes: key: relay_node_id value: {rule_name: [u, d]}
+    """
+    deltas = {}
+    for rule_id, node_id, name in RelayRule.objects.filter(
+        relay_node_id__in=list(relay_nodes)
+    ).values_list("id", "relay_node_id", "name"):
+        if name in relay_nodes[node_id]:
+            u, d = relay_nodes[node_id][name]
+            deltas[rule_id] = {"up_traffic": u, "down_traffic": d}
+    return bulk_incr(RelayRule, deltas)
+
+
+def apply_node_traffic(nodes: dict):
+    """
+    把汇总好的节点流量写入数据库
+    1 更新节点流量和带宽
+    2 更新用户流量/占用流量
+    3 记录流量日志
+    4 关闭超出流量的节点
+    """
+    node_map = ProxyNode.objects.in_bulk(list(nodes))
+    occupancy_map = {
+        (node_id, user_id): o["id"]
+        for node_id in node_map
+        for user_id, o in UserProxyNodeOccupancy.get_node_occupancy_map(node_id).items()
+    }
+    user_deltas = defaultdict(lambda: {"upload_traffic": 0, "download_traffic": 0})
+    occupancy_deltas = defaultdict(lambda: {"used_traffic": 0})
+    node_deltas = {}
+    node_bandwidths = {}
+    trafficlog_model_list = []
+    for node_id, node_traffic in nodes.items():
+        if node_id not in node_map:
+            continue
+        for user_id, (u, d) in node_traffic["users"].items():
+            occupancy_id = occupancy_map.get((node_id, user_id))
+            if occupancy_id:
+                occupancy_deltas[occupancy_id]["used_traffic"] += u + d
+            else:
+                user_deltas[user_id]["upload_traffic"] += u
+                user_deltas[user_id]["download_traffic"] += d
+            trafficlog_model_list.append(
+                UserTrafficLog(
+                    proxy_node_id=node_id,
+                    user_id=user_id,
+                    upload_traffic=u,
+                    download_traffic=d,
+                    ip_list=node_traffic["ip_list"].get(user_id, []),
+                )
+            )
+        if not node_traffic["users"]:
+            # NOTE add blank log to show node is online
+            trafficlog_model_list.append(UserTrafficLog(proxy_node_id=node_id))
+        node_deltas[node_id] = {"used_traffic": node_traffic.get("total_traffic", 0)}
+        node_bandwidths[node_id] = {
+            "current_used_upload_bandwidth_bytes": node_traffic.get("u_bandwidth", 0),
+            "current_used_download_bandwidth_bytes": node_traffic.get("d_bandwidth", 0),
+        }
+
+    user_usage = _get_usage(User, user_deltas, "total_traffic")
+    occupancy_usage = _get_usage(
+        UserProxyNodeOccupancy, occupancy_deltas, "total_traffic"
+    )
+    # NOTE 跳过已经被删除的用户
+    trafficlog_model_list = [
+        log
+        for log in trafficlog_model_list
+        if log.user_id is None
+        or log.user_id in user_usage
+        or (log.proxy_node_id, log.user_id) in occupancy_map
+    ]
+    with transaction.atomic():
+        bulk_incr(User, user_deltas, last_use_time=utils.get_current_datetime())
+        bulk_incr(UserProxyNodeOccupancy, occupancy_deltas)
+        bulk_incr(ProxyNode, node_deltas, node_bandwidths)
+        UserTrafficLog.objects.bulk_create(trafficlog_model_list)
+
+    # 关闭超出流量的节点
+    # NOTE update 不会触发信号，有节点被关闭时自己更新拓扑版本号
+    if ProxyNode.objects.filter(
+        id__in=list(node_deltas), enable=True, used_traffic__gt=F("total_traffic")
+    ).update(enable=False):
+        transaction.on_commit(version.touch_topology)
+    # 流量用完的用户/占用需要通知节点更新配置
+    # NOTE 可能在外层的事务里，提交之后再更新版本号
+    if _crossed_limit(user_usage, user_deltas):
+        transaction.on_commit(version.touch_users)
+    occupancy_node_ids = {oid: node_id for (node_id, _), oid in occupancy_map.items()}
+    for occupancy_id in _crossed_limit(occupancy_usage, occupancy_deltas):
+        node_id = occupancy_node_ids[occupancy_id]
+        transaction.on_commit(lambda node_id=node_id: version.touch_proxy_node(node_id))
+
+
+def _get_usage(model, deltas, total_field):
+    """NOTE key: pk value: (已用, 总量) 写入增量之前的值"""
+    if not deltas:
+        return {}
+    used_fields = list(next(iter(deltas.values())))
+    return {
+        row["pk"]: (sum(row[f] for f in used_fields), row[total_field])
+        for row in model.objects.filter(pk__in=list(deltas)).values(
+            "pk", total_field, *used_fields
+        )
+    }
+
+
+def _crossed_limit(usage, deltas):
+    """返回加上增量后刚好用完流量的 pk"""
+    crossed = []
+    for pk, (used, total) in usage.items():
+        if used < total <= used + sum(deltas[pk].values()):
+            crossed.append(pk)
+    return crossed
+
+
+traffic_buffer = TrafficBuffer(redis_client=redis)
@@ -0,0 +1,86 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.extensions import codec
+from apps.extensions.codec import Codec
+
+
+def gen_payloads(user_count, node_count):
+    """和缓存里实际存的数据形状差不多的几种值"""
+    users = [
+        {
+            "user_id": i,
+            "password": f"p{i:06d}",
+            "enable": True,
+            "method": "aes-256-gcm",
+        }
+        for i in range(user_count)
+    ]
+    sub = "proxies:\n" + "".join(
+        f"  - name: node-{i}\n    server: 1.2.3.{i % 250}\n    port: {10000 + i}\n"
+        f"    type: ss\n    cipher: aes-256-gcm\n    password: abcdef{i}\n"
+        for i in range(node_count)
+    )
+    return {
+        f"user configs({user_count})": users,
+        f"subscription({node_count} nodes)": {
+            "content": sub,
+            "content_type": "text/plain; charset=utf-8",
+            "etag": '"d41d8cd98f00b204e9800998ecf8427e"',
+            "last_modified": int(time.time()),
+        },
+        "node snapshot(bytes)": json.dumps({"users": users}).encode(),
+        "float": 12.34,
+    }
+
+
+class Command(BaseCommand):
+    help = """
+            对比缓存各种序列化/压缩方式的编码、解码耗时和大小 EXAMPLE
+            python manage.py bench_cache_codec --users 5000 --nodes 300
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=5000, help="用户配置数量")
+        parser.add_argument("--nodes", type=int, default=300, help="订阅里的节点数量")
+        parser.add_argument("--repeat", type=int, default=200, help="每项重复次数")
+        parser.add_argument(
+            "--compress-threshold",
+            type=int,
+            default=8192,
+            help="超过多少字节压缩，和 CACHE_COMPRESS_THRESHOLD 一样",
+        )
+
+    def _bench(self, fn, repeat):
+        """返回 (平均耗时 us, 最后一次的结果)"""
+        start = time.perf_counter()
+        for _ in range(repeat):
+            rv = fn()
+        return (time.perf_counter() - start) / repeat * 1e6, rv
+
+    def handle(self, *args, **options):
+        repeat = options["repeat"]
+        threshold = options["compress_threshold"]
+        serializers = [s for s in Codec.SERIALIZERS if s != "msgpack" or codec.msgpack]
+        compress_name = "zstd" if codec.zstandard else "zlib"
+        self.stdout.write(
+            f"orjson:{bool(codec.orjson)} msgpack:{bool(codec.msgpack)} "
+            f"zstandard:{bool(codec.zstandard)} repeat:{repeat}"
+        )
+        self.stdout.write(
+            f"{'payload':<28}{'codec':<16}{'enc(us)':>10}{'dec(us)':>10}{'size':>10}"
+        )
+        for name, value in gen_payloads(options["users"], options["nodes"]).items():
+            for serializer in serializers:
+                for compress_threshold in (0, threshold):
+                    c = Codec(serializer, compress_threshold)
+                    enc, data = self._bench(lambda: c.dumps(value), repeat)
+                    dec, _ = self._bench(lambda: c.loads(data), repeat)
+                    label = serializer + (
+                        f"+{compress_name}" if compress_threshold else ""
+                    )
+                    self.stdout.write(
+                        f"{name:<28}{label:<16}{enc:>10.1f}{dec:>10.1f}{len(data):>10}"
+                    )
@@ -81,10 +81,16 @@ class User(AbstractUser):
         return self.username
 
     @classmethod
-    @cache.cached()
+    @cache.cached(local_ttl=60, serializer="pickle")
     def get_by_id_with_cache(cls, id):
         return cls.objects.get(id=id)
 
+    @classmethod
+    @cache.cached(ttl=c.CACHE_TTL_HOUR, none_ttl=60)
+    def get_id_by_uid(cls, uid: str):
+        """订阅链接的 uid 换成用户 id，不存在的 uid 也缓存一会儿，乱扫 uid 不会打到数据库"""
+        return cls.objects.filter(uid=uid).values_list("id", flat=True).first()
+
     @classmethod
     def get_total_user_num(cls):
         """返回用户总数"""
@@ -187,15 +193,6 @@ class User(AbstractUser):
         # NOTE 后台展示用 暂时不加索引
         return cls.objects.all().order_by("-download_traffic")[:count]
 
-    @classmethod
-    def get_new_user_count_by_datetime(cls, date: pendulum.DateTime):
-        return cls.objects.filter(
-            date_joined__range=[
-                date.start_of("day"),
-                date.end_of("day"),
-            ]
-        ).aggregate(count=models.Count("id"))["count"]
-
     @property
     def sub_link(self):
         """订阅地址"""
@@ -314,8 +311,11 @@ class User(AbstractUser):
         return {"Subscription-Userinfo": info}
 
     def reset_sub_uid(self):
+        old_uid = str(self.uid)
         self.uid = str(uuid4())
         self.save()
+        # NOTE 旧的订阅链接马上失效
+        User.get_id_by_uid.invalidate(User, old_uid)
 
 
 class UserMixin:
@@ -500,26 +500,6 @@ class UserOrder(models.Model, UserMixin):
                 order.handle_paid()
             return success
 
-    @classmethod
-    def get_success_order_count(cls, dt: pendulum.DateTime):
-        return cls.objects.filter(
-            created_at__range=[dt.start_of("day"), dt.end_of("day")],
-            status=cls.STATUS_FINISHED,
-        ).count()
-
-    @classmethod
-    def get_success_order_amount(cls, date: pendulum.DateTime):
-        return (
-            cls.objects.filter(
-                status=cls.STATUS_FINISHED,
-                created_at__range=[
-                    date.start_of("day"),
-                    date.end_of("day"),
-                ],
-            ).aggregate(amount=models.Sum("amount"))["amount"]
-            or "0"
-        )
-
     def handle_paid(self):
         # NOTE Must use in transaction
         self.refresh_from_db()
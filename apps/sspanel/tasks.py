@@ -1,10 +1,28 @@
 from urllib.error import URLError
 
+import pendulum
 from django.conf import settings
 from django.core.mail import send_mail
+from redis.exceptions import LockError
 
 from apps import celery_app
-from apps.proxy.models import ProxyNode, UserProxyNodeOccupancy, UserTrafficLog
+from apps.mixin import bulk_purge
+from apps.proxy.models import (
+    ProxyNode,
+    RelayNode,
+    TrafficBufferFlushLog,
+    UserProxyNodeOccupancy,
+    UserTrafficDailyRollup,
+    UserTrafficHourlyRollup,
+    UserTrafficLog,
+)
+from apps.proxy.traffic import (
+    apply_node_traffic,
+    apply_relay_traffic,
+    summarize_node_report,
+    summarize_relay_report,
+    traffic_buffer,
+)
 from apps.sspanel import models as m
 from apps.utils import get_current_datetime
 
@@ -20,91 +38,35 @@ def sync_user_traffic_task(node_id, data):
     """
     这个接口操作比较重，所以为了避免发信号
     所有写操作都需要用BULK的方式
-    1 更新节点流量
-    2 更新用户流量
-    3 记录节点在线IP
-    4 关闭超出流量的节点
+    流量都是用 F() 表达式原子地加上去的，和缓冲刷入走同一套逻辑
     """
     node: ProxyNode = ProxyNode.get_or_none(node_id)
     if not node:
         return
-    node_occurred_user_ids = [
-        i["user_id"] for i in UserProxyNodeOccupancy.get_node_occupancy_user_ids(node)
-    ]
-    node_total_traffic = 0
-    log_time = get_current_datetime()
-    user_model_list = []
-    trafficlog_model_list = []
-    traffic_data = data.get("data", [])
-
-    # load user in batch
-    user_ids = []
-    for user_data in traffic_data:
-        user_id = user_data["user_id"]
-        user_ids.append(user_data["user_id"])
-    user_map = {}
-    for u in m.User.objects.filter(id__in=user_ids):
-        user_map[u.id] = u
-
-    for user_data in traffic_data:
-        user_id = int(user_data["user_id"])
-        user = user_map[user_id]
-        u = int(int(user_data["upload_traffic"]) * node.enlarge_scale)
-        d = int(int(user_data["download_traffic"]) * node.enlarge_scale)
-
-        # 节点流量增量
-        node_total_traffic += u + d
-
-        # 记录用户占用节点流量
-        if user_id in node_occurred_user_ids:
-            UserProxyNodeOccupancy.check_and_incr_traffic(
-                user_id=user_id, proxy_node_id=node_id, traffic=d + u
-            )
-        else:
-            # 个人流量增量
-            user.download_traffic += d
-            user.upload_traffic += u
-            user.last_use_time = log_time
-            user_model_list.append(user)
-        # 流量记录
-        trafficlog_model_list.append(
-            UserTrafficLog(
-                proxy_node=node,
-                user=user,
-                download_traffic=u,
-                upload_traffic=d,
-                ip_list=user_data.get("ip_list", []),
-            )
-        )
+    apply_node_traffic({node.id: summarize_node_report(node, data)})
 
-    if not traffic_data:
-        # NOTE add blank log to show node is online
-        trafficlog_model_list.append(UserTrafficLog(proxy_node=node))
-    # 节点流量记录
-    node.used_traffic += node_total_traffic
-    if node.overflow:
-        node.enable = False
-    node.current_used_download_bandwidth_bytes = int(data.get("download_bandwidth", 0))
-    node.current_used_upload_bandwidth_bytes = int(data.get("upload_bandwidth", 0))
-    node.save(
-        update_fields=[
-            "used_traffic",
-            "enable",
-            "current_used_download_bandwidth_bytes",
-            "current_used_upload_bandwidth_bytes",
-        ]
-    )
-    # 用户流量
-    m.User.objects.bulk_update(
-        user_model_list,
-        [
-            "download_traffic",
-            "upload_traffic",
-            "last_use_time",
-        ],
-    )
-    # 流量记录
-    UserTrafficLog.objects.bulk_create(trafficlog_model_list)
+
+@celery_app.task
+def sync_relay_traffic_task(node_id, data):
+    """中转规则的流量按规则汇总后批量写入"""
+    node: RelayNode = RelayNode.get_or_none(node_id)
+    if not node:
+        return
+    apply_relay_traffic({node.id: summarize_relay_report(node, data)})
+
+
+@celery_app.task
+def flush_traffic_buffer_task():
+    """把 redis 里缓冲的节点流量批量写入数据库"""
+    if not settings.TRAFFIC_BUFFER_ENABLED:
+        return
+    try:
+        count = traffic_buffer.flush()
+    except LockError:
+        # NOTE 上一次还没刷完，等下次就好
+        return
+    if count:
+        print(f"traffic buffer flushed node count:{count}")
 
 
 @celery_app.task
@@ -112,6 +74,7 @@ def check_user_state_task():
     """检测用户状态，将所有账号到期的用户状态重置"""
     m.User.check_and_disable_expired_users()
     m.User.check_and_disable_out_of_traffic_user()
+    UserProxyNodeOccupancy.touch_expired_occupancy_nodes()
 
 
 @celery_app.task
@@ -141,11 +104,71 @@ def make_up_lost_order_task():
 
 @celery_app.task
 def clean_traffic_log_task():
-    """清空七天前的所有流量记录"""
-    dt = get_current_datetime().subtract(days=7)
-    query = UserTrafficLog.objects.filter(created_at__lt=dt)
-    count = query._raw_delete(query.db)
-    print(f"UserTrafficLog  removed count:{count}")
+    """清空超过保留天数的流量记录，表分过区时直接删分区，否则分批删除"""
+    retention_days = settings.TRAFFIC_LOG_RETENTION_DAYS
+    dt = get_current_datetime().subtract(days=retention_days)
+    # NOTE 刷入记录只用来防止同一批重复写入，不用留很久
+    TrafficBufferFlushLog.objects.filter(created_at__lt=dt).delete()
+    # NOTE 重新汇总每日数据要读小时汇总，至少要比原始记录多留一天
+    rollup_retention_days = max(
+        settings.TRAFFIC_HOURLY_ROLLUP_RETENTION_DAYS, retention_days + 1
+    )
+    bulk_purge(
+        UserTrafficHourlyRollup.objects.filter(
+            bucket__lt=get_current_datetime().subtract(days=rollup_retention_days)
+        ),
+        checkpoint="retention",
+    )
+    if UserTrafficLog.partition_enabled():
+        created = UserTrafficLog.ensure_partitions()
+        dropped = UserTrafficLog.drop_expired_partitions(retention_days)
+        if created or dropped:
+            print(f"UserTrafficLog partitions created:{created} dropped:{dropped}")
+        return
+    bulk_purge(UserTrafficLog.objects.filter(created_at__lt=dt), checkpoint="retention")
+
+
+@celery_app.task
+def rollup_traffic_task(hours=None):
+    """
+    从上次汇总到的小时开始，重新汇总流量记录到小时/每日汇总表
+    定时任务停过一段时间也能接上，最多补到原始记录的保留时间
+    补历史数据时可以手动传 hours，从 hours 小时之前开始汇总
+    """
+    now = get_current_datetime()
+    if hours:
+        start = now.subtract(hours=hours)
+    else:
+        start = UserTrafficHourlyRollup.get_watermark() or now.subtract(hours=1)
+    # NOTE 更早的原始记录已经删掉了，重新汇总只会漏数据
+    start = max(start, now.subtract(days=settings.TRAFFIC_LOG_RETENTION_DAYS))
+    # NOTE 每日汇总按本地时区分天
+    start = start.in_timezone(now.timezone)
+    hourly_count = UserTrafficHourlyRollup.rollup(start)
+    daily_count = 0
+    dates = []
+    for dt in pendulum.interval(start.start_of("day"), now).range("days"):
+        daily_count += UserTrafficDailyRollup.rollup(dt)
+        dates.append(dt.date())
+    # NOTE 今天的数据不走缓存，之前的天数重算了要把缓存删掉，不然会一直是旧的
+    # 只删重算到的用户/节点的缓存，其他用户的缓存不受影响
+    if past_dates := [d for d in dates if d < now.date()]:
+        changed = (
+            UserTrafficHourlyRollup.objects.filter(
+                bucket__gte=start.start_of("hour"), bucket__lt=now.start_of("day")
+            )
+            .values_list("user_id", "proxy_node_id")
+            .distinct()
+            .order_by()
+        )
+        UserTrafficLog.drop_traffic_cache(
+            past_dates,
+            user_ids={user_id for user_id, _ in changed},
+            proxy_node_ids={node_id for _, node_id in changed},
+        )
+    # NOTE 刚过整点时上个小时可能还有没提交的记录，留一点余量下次再汇总一遍
+    UserTrafficHourlyRollup.set_watermark(now.subtract(minutes=10).start_of("hour"))
+    print(f"traffic rollup hourly count:{hourly_count} daily count:{daily_count}")
 
 
 @celery_app.task
@@ -210,8 +210,8 @@ class UserInfoView(LoginRequiredMixin, View):
         anno = Announcement.objects.first()
         min_traffic = traffic_format(settings.MIN_CHECKIN_TRAFFIC)
         max_traffic = traffic_format(settings.MAX_CHECKIN_TRAFFIC)
-        user_active_nodes = ProxyNode.get_user_active_nodes(user)
-        user_active_nodes_types = {node.node_type for node in user_active_nodes}
+        user_active_nodes = ProxyNode.get_user_visible_nodes(user)
+        user_active_nodes_types = {node["node_type"] for node in user_active_nodes}
         if len(user_active_nodes_types) > 1:
             user_active_nodes_types.add("all")
         context = {
@@ -221,7 +221,7 @@ class UserInfoView(LoginRequiredMixin, View):
             "max_traffic": max_traffic,
             "themes": THEME_CHOICES,
             "sub_link": user.sub_link,
-            "active_node_count": user_active_nodes.count(),
+            "active_node_count": len(user_active_nodes),
             "active_node_types": user_active_nodes_types,
             "supported_clients": UserSubManager.CLIENT_SET,
             "usp_list": UserSocialProfile.list_by_user_id(user.id),
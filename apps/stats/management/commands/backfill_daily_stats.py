@@ -0,0 +1,43 @@
+import pendulum
+from django.core.management.base import BaseCommand, CommandError
+
+from apps import utils
+from apps.stats.models import DailyStats
+
+
+class Command(BaseCommand):
+    help = """
+            批量生成每日记录 EXAMPLE
+            python manage.py backfill_daily_stats --start 2023-01-01 --end 2023-12-31 --force
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", required=True, help="开始日期 YYYY-MM-DD")
+        parser.add_argument("--end", default=None, help="结束日期 YYYY-MM-DD，默认今天")
+        parser.add_argument(
+            "--force", action="store_true", help="已经有记录的日期也重新计算"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            start = pendulum.parse(options["start"]).date()
+            end = (
+                pendulum.parse(options["end"]).date()
+                if options["end"]
+                else utils.get_current_datetime().date()
+            )
+        except ValueError as e:
+            raise CommandError(f"invalid date: {e}")
+        if start > end:
+            raise CommandError("--start must not be later than --end")
+
+        dates = [start.add(days=i) for i in range((end - start).days + 1)]
+        if options["force"] and (unsafe := DailyStats.get_unsafe_force_dates(dates)):
+            raise CommandError(
+                f"--force would reset active users and traffic of {unsafe[0]} ~ "
+                f"{unsafe[-1]} to 0, the traffic rollup has no data for these days. "
+                "Backfill the rollup first or start from a later date"
+            )
+        count = DailyStats.backfill(dates, force=options["force"])
+        if options.get("verbosity", 0) >= 1:
+            self.stdout.write(f"DailyStats {start} ~ {end} backfilled days: {count}")
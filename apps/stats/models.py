@@ -1,8 +1,12 @@
 import decimal
+from collections import defaultdict
+from datetime import timezone as dt_timezone
 from typing import List
 
 import pendulum
-from django.db import models
+from django.conf import settings
+from django.db import connection, models
+from django.db.models.functions import TruncHour
 
 from apps import utils
 from apps.proxy import models as pm
@@ -41,38 +45,165 @@ class DailyStats(models.Model):
     def __str__(self) -> str:
         return str(self.date)
 
+    UPDATE_FIELDS = [
+        "new_user_count",
+        "active_user_count",
+        "checkin_user_count",
+        "order_count",
+        "order_amount",
+        "cost_amount",
+        "total_used_traffic",
+        "updated_at",
+    ]
+
     @classmethod
     def create_or_update_stats(cls, dt: pendulum.DateTime):
+        """今天的记录每次都重新算，之前的记录有了就不再更新"""
         date = dt.date()
-        today = utils.get_current_datetime().date()
-        log, _ = cls.objects.get_or_create(date=date)
-        # 如果是今天之前的记录就不在更新了
-        if date < today:
-            return log
+        cls.backfill([date], force=date == utils.get_current_datetime().date())
+        return cls.objects.get(date=date)
 
-        log.new_user_count = sm.User.get_new_user_count_by_datetime(dt)
-        log.active_user_count = pm.UserTrafficLog.get_active_user_count_by_datetime(dt)
-        log.checkin_user_count = sm.UserCheckInLog.get_checkin_user_count(dt.date())
+    @classmethod
+    def _sum_by_local_date(cls, rows, tz, *fields):
+        """
+        按 UTC 小时分组的结果再按本地日期加起来
+        NOTE 和流量汇总一样按 UTC 截断到小时，避免 mysql 的 CONVERT_TZ，
+        时区偏移不是整小时的话会有一点误差
+        """
+        result = defaultdict(lambda: [0] * len(fields))
+        for row in rows:
+            values = result[pendulum.instance(row["bucket"]).in_tz(tz).date()]
+            for i, field in enumerate(fields):
+                values[i] += row[field] or 0
+        return result
 
-        log.order_count = sm.UserOrder.get_success_order_count(dt)
-        log.order_amount = decimal.Decimal(sm.UserOrder.get_success_order_amount(dt))
+    @classmethod
+    def _calc_stats(cls, dates):
+        """每张源表一次 GROUP BY，算出每天所有的指标"""
+        tz = utils.get_current_datetime().timezone
+        start = min(dates)
+        end = max(dates)
+        start_dt = pendulum.datetime(start.year, start.month, start.day, tz=tz)
+        end_dt = pendulum.datetime(end.year, end.month, end.day, tz=tz).end_of("day")
 
-        log.total_used_traffic = pm.UserTrafficLog.calc_traffic_by_datetime(dt)
-        log.cost_amount = (
+        new_users = cls._sum_by_local_date(
+            sm.User.objects.filter(date_joined__range=[start_dt, end_dt])
+            .annotate(bucket=TruncHour("date_joined", tzinfo=dt_timezone.utc))
+            .values("bucket")
+            .annotate(count=models.Count("id"))
+            .order_by(),
+            tz,
+            "count",
+        )
+        orders = cls._sum_by_local_date(
+            sm.UserOrder.objects.filter(
+                created_at__range=[start_dt, end_dt],
+                status=sm.UserOrder.STATUS_FINISHED,
+            )
+            .annotate(bucket=TruncHour("created_at", tzinfo=dt_timezone.utc))
+            .values("bucket")
+            .annotate(count=models.Count("id"), amount=models.Sum("amount"))
+            .order_by(),
+            tz,
+            "count",
+            "amount",
+        )
+        checkins = {
+            row["date"]: row["count"]
+            for row in sm.UserCheckInLog.objects.filter(date__range=[start, end])
+            .values("date")
+            .annotate(count=models.Count("id"))
+            .order_by()
+        }
+        traffics = {
+            row["bucket"]: row
+            for row in pm.UserTrafficDailyRollup.objects.filter(
+                bucket__range=[start, end]
+            )
+            .values("bucket")
+            .annotate(
+                users=models.Count("user_id", distinct=True),
+                u=models.Sum("upload_traffic"),
+                d=models.Sum("download_traffic"),
+            )
+            .order_by()
+        }
+        # NOTE 成本按现在的节点价格算，和单天的逻辑一样
+        cost_amount = (
             pm.ProxyNode.calc_all_cost_price() + pm.RelayNode.calc_all_cost_price()
         ) / 30
-        log.save()
-        return log
+
+        stats = []
+        for date in dates:
+            order_count, order_amount = orders.get(date, [0, 0])
+            traffic = traffics.get(date, {"users": 0, "u": 0, "d": 0})
+            stats.append(
+                cls(
+                    date=date,
+                    new_user_count=new_users.get(date, [0])[0],
+                    active_user_count=traffic["users"],
+                    checkin_user_count=checkins.get(date, 0),
+                    order_count=order_count,
+                    order_amount=decimal.Decimal(order_amount),
+                    cost_amount=cost_amount,
+                    total_used_traffic=round(
+                        (traffic["u"] + traffic["d"]) / settings.GB, 2
+                    ),
+                )
+            )
+        return stats
+
+    @classmethod
+    def get_unsafe_force_dates(cls, dates):
+        """
+        活跃用户和流量只从流量每日汇总表算，汇总表最早的一天之前没有数据，
+        这些日期已有的记录强制重算会被写成 0，返回这样的日期
+        """
+        first = pm.UserTrafficDailyRollup.objects.aggregate(first=models.Min("bucket"))[
+            "first"
+        ]
+        query = cls.objects.filter(date__in=dates)
+        if first:
+            query = query.filter(date__lt=first)
+        return sorted(query.values_list("date", flat=True))
+
+    @classmethod
+    def backfill(cls, dates, force=False):
+        """
+        批量计算多天的记录，查询次数和天数无关，最后一次 upsert
+        不加 force 的时候已经有记录的日期会跳过，返回写入的天数
+        """
+        dates = sorted(set(dates))
+        if not force:
+            exists = set(
+                cls.objects.filter(date__in=dates).values_list("date", flat=True)
+            )
+            dates = [d for d in dates if d not in exists]
+        if not dates:
+            return 0
+        # NOTE mysql 不支持指定冲突的字段，靠唯一索引判断
+        unique_fields = (
+            ["date"]
+            if connection.features.supports_update_conflicts_with_target
+            else None
+        )
+        cls.objects.bulk_create(
+            cls._calc_stats(dates),
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=cls.UPDATE_FIELDS,
+        )
+        return len(dates)
 
     @classmethod
     def get_date_str_dict(cls, dt_list: List[pendulum.DateTime]):
         """NOTE key: date_str  value: log"""
-        log_dict = {
-            str(log.date): log
-            for log in cls.objects.filter(date__in=[dt.date() for dt in dt_list])
-        }
-
-        for dt in dt_list:
-            if not log_dict.get(str(dt.date())):
-                log_dict[str(dt.date())] = cls.create_or_update_stats(dt)
+        dates = [dt.date() for dt in dt_list]
+        log_dict = {str(log.date): log for log in cls.objects.filter(date__in=dates)}
+        missing = [date for date in dates if str(date) not in log_dict]
+        if missing:
+            cls.backfill(missing, force=True)
+            for log in cls.objects.filter(date__in=missing):
+                log_dict[str(log.date)] = log
         return log_dict
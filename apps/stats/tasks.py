@@ -1,10 +1,24 @@
 from apps import celery_app, utils
+from apps.proxy.models import UserTrafficHourlyRollup
 from apps.stats import models
 
 
 @celery_app.task
 def gen_daily_stats_task():
-    """生成昨天的记录，和更新今天的记录"""
-    today = utils.get_current_datetime()
-    models.DailyStats.create_or_update_stats(today)
-    models.DailyStats.create_or_update_stats(today.add(days=-1))
+    """更新今天的记录，流量汇总过了零点之后再把昨天的记录最后算一次"""
+    now = utils.get_current_datetime()
+    midnight = now.start_of("day")
+    dates = [now.date()]
+    # NOTE 昨天的记录零点之后没更新过才需要重算，算过一次 updated_at 就过了零点，
+    # 不会每次都整天重算，也不会一直用现在的价格覆盖昨天的成本
+    watermark = UserTrafficHourlyRollup.get_watermark()
+    yesterday = midnight.subtract(days=1).date()
+    if (
+        watermark
+        and watermark >= midnight
+        and not models.DailyStats.objects.filter(
+            date=yesterday, updated_at__gte=midnight
+        ).exists()
+    ):
+        dates.append(yesterday)
+    models.DailyStats.backfill(dates, force=True)
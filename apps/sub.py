@@ -1,9 +1,13 @@
 import base64
+import hashlib
 
 from django.conf import settings
 from django.template.loader import render_to_string
 
+from apps.ext import version
+from apps.proxy.models import ProxyNode
 from apps.sspanel.models import User
+from apps.utils import is_ip_address
 
 
 class UserSubManager:
@@ -19,7 +23,7 @@ class UserSubManager:
         CLIENT_CLASH_PROXY_PROVIDER,
     }
 
-    def __init__(self, user, node_list, sub_client=CLIENT_CLASH):
+    def __init__(self, user, node_ids, sub_client=CLIENT_CLASH):
         self.user = user
         if sub_client in self.CLIENT_SET:
             self.sub_client = sub_client
@@ -28,7 +32,24 @@ class UserSubManager:
         else:
             raise ValueError(f"sub_client {sub_client} not support")
 
-        self.node_list = node_list
+        self.node_ids = node_ids
+
+    @classmethod
+    def get_cache_key(cls, user: User, *parts):
+        """
+        订阅内容的缓存 key
+        节点拓扑/占用的版本，用户的密码/等级，请求参数任意一个变了 key 就会变
+        """
+        raw = ".".join(
+            str(p)
+            for p in (
+                version.get_subscription_version(),
+                user.proxy_password,
+                user.level,
+                *parts,
+            )
+        )
+        return f"sub.{user.uid}.{hashlib.sha1(raw.encode()).hexdigest()}"
 
     def _get_clash_sub_yaml(self):
         user: User = self.user
@@ -51,23 +72,27 @@ class UserSubManager:
             },
         )
 
-    def _get_shadowrocket_sub_links(self):
-        sub_links = ""
-        # for clean the rule have the same port
-        # key: relay_node_id+port, value: shadowrocket_sub_link
+    def _get_endpoints(self):
+        """
+        从共享的拓扑快照里取出直连和中转的节点，只剩下用户密码需要填
+        NOTE 中转规则按 relay_node_id+port 去重，后面的覆盖前面的
+        """
+        direct_endpoints = []
         relay_node_group = {}
-        for node in self.node_list:
-            if node.enable_relay:
-                for rule in node.get_enabled_relay_rules():
-                    key = f"{rule.relay_node.id}{rule.relay_port}"
-                    relay_node_group[key] = node.get_user_shadowrocket_sub_link(
-                        self.user, rule
-                    )
-            if node.enable_direct:
-                sub_links += node.get_user_shadowrocket_sub_link(self.user) + "\n"
-
-        for link in relay_node_group.values():
-            sub_links += link + "\n"
+        for entry in ProxyNode.get_sub_topology(self.node_ids):
+            for key, endpoint in entry["relays"]:
+                relay_node_group[key] = endpoint
+            if entry["direct"]:
+                direct_endpoints.append(entry["direct"])
+        return direct_endpoints, list(relay_node_group.values())
+
+    def _get_shadowrocket_sub_links(self):
+        password = self.user.proxy_password
+        direct_endpoints, relay_endpoints = self._get_endpoints()
+        sub_links = "".join(
+            ProxyNode.gen_shadowrocket_sub_link(endpoint, password) + "\n"
+            for endpoint in direct_endpoints + relay_endpoints
+        )
         sub_links = base64.urlsafe_b64encode(sub_links.encode()).decode()
         return sub_links
 
@@ -83,29 +108,27 @@ class UserSubManager:
 
     def get_clash_proxy_providers(self):
         """todo support multi provider group"""
-        node_configs = []
-        # for clean the rule have the same port
-        # key: relay_node_id+port, value: clash cfg
-        relay_node_group = {}
-        for node in self.node_list:
-            if node.enable_relay:
-                for rule in node.get_enabled_relay_rules():
-                    key = f"{rule.relay_node.id}{rule.relay_port}"
-                    relay_node_group[key] = {
-                        "clash_config": node.get_user_clash_config(self.user, rule),
-                        "name": rule.name,
-                    }
-
-            if node.enable_direct:
-                node_configs.append(
-                    {
-                        "clash_config": node.get_user_clash_config(self.user),
-                        "name": node.remark,
-                    }
-                )
-        for cfg in relay_node_group.values():
-            node_configs.append(cfg)
+        password = self.user.proxy_password
+        direct_endpoints, relay_endpoints = self._get_endpoints()
+        node_configs = [
+            {
+                "clash_config": ProxyNode.gen_clash_config(endpoint, password),
+                "name": endpoint["remark"],
+            }
+            for endpoint in direct_endpoints + relay_endpoints
+        ]
         return render_to_string(
             "clash/providers.yaml",
             {"nodes": sorted(node_configs, key=lambda x: x["name"])},
         )
+
+    def get_rule_set(self, is_ip: bool):
+        """直连规则里需要的节点 host"""
+        direct_endpoints, relay_endpoints = self._get_endpoints()
+        return sorted(
+            {
+                endpoint["host"]
+                for endpoint in direct_endpoints + relay_endpoints
+                if is_ip == is_ip_address(endpoint["host"])
+            }
+        )
@@ -168,22 +168,28 @@ class DashBoardManger:
         }
 
     @classmethod
-    def gen_traffic_line_chart_configs(cls, user_id, node_id, dt_list):
+    def gen_traffic_line_chart_configs(
+        cls, user_id, node_id, start, end, granularity=pm.UserTrafficLog.GRANULARITY_DAY
+    ):
         proxy_node = pm.ProxyNode.get_or_none(node_id)  # node must exists
         user_total_traffic = pm.UserTrafficLog.calc_user_total_traffic(
             proxy_node, user_id
         )
-        dt_list = sorted(dt_list)
+        dt_list, data = pm.UserTrafficLog.get_traffic_series(
+            start, end, granularity, user_id, proxy_node
+        )
+        if granularity == pm.UserTrafficLog.GRANULARITY_HOUR:
+            labels = [t.format("MM-DD HH:00") for t in dt_list]
+        else:
+            labels = ["{}-{}".format(t.month, t.day) for t in dt_list]
         return {
             "title": "节点 {} 当月共消耗：{}".format(
                 proxy_node.name, user_total_traffic
             ),
-            "labels": ["{}-{}".format(t.month, t.day) for t in dt_list],
-            "data": [
-                pm.UserTrafficLog.calc_traffic_by_datetime(dt, user_id, proxy_node)
-                for dt in dt_list
-            ],
+            "labels": labels,
+            "data": data,
             "data_title": proxy_node.name,
+            "y_label": "GB",
         }
 
     @classmethod
@@ -54,12 +54,28 @@ def traffic_rate_format(traffic):
     return f"{traffic_format(traffic)}/s"
 
 
+def check_api_token(request):
+    """token 不对时返回错误信息，异步的 view 用不了装饰器，直接调这个"""
+    token = request.GET.get("token", "")
+    if token != settings.TOKEN:
+        return JsonResponse({"msg": "auth error"})
+
+
+def parse_json_request(request):
+    """解析 json 请求体放到 request.json 上，解析失败时返回 400"""
+    if request.headers.get("Content-Type") != "application/json":
+        return JsonResponse({"msg": "bad request"}, status=400)
+    try:
+        request.json = json.loads(request.body)
+    except Exception:
+        return JsonResponse({"msg": "bad request"}, status=400)
+
+
 def api_authorized(view_func):
     @wraps(view_func)
     def wrapper(request, *args, **kwargs):
-        token = request.GET.get("token", "")
-        if token != settings.TOKEN:
-            return JsonResponse({"msg": "auth error"})
+        if response := check_api_token(request):
+            return response
         return view_func(request, *args, **kwargs)
 
     return wrapper
@@ -68,12 +84,8 @@ def api_authorized(view_func):
 def handle_json_request(view_func):
     @wraps(view_func)
     def wrapper(request, *args, **kw):
-        if request.headers.get("Content-Type") != "application/json":
-            return
-        try:
-            request.json = json.loads(request.body)
-        except Exception:
-            return JsonResponse({"msg": "bad request"}, status=400)
+        if response := parse_json_request(request):
+            return response
         return view_func(request, *args, **kw)
 
     return wrapper
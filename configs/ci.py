@@ -0,0 +1,15 @@
+import os
+
+from configs.default.common import BASE_DIR
+
+# NOTE ci 没有 mysql，跑测试用 sqlite，redis 还是读 REDIS_* 环境变量
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+        # NOTE 多线程的测试会并发写，等锁而不是直接报 database is locked
+        "OPTIONS": {"timeout": 30},
+        # NOTE 用文件而不是内存库，多个线程的连接才能看到同一份数据
+        "TEST": {"NAME": os.path.join(BASE_DIR, "test_db.sqlite3")},
+    }
+}
@@ -57,6 +57,9 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "apps.wsgi.application"
+ASGI_APPLICATION = "apps.asgi.application"
+# 节点和订阅接口是否使用异步的 view，由 apps/asgi.py 打开，uwsgi 下保持关闭
+ASYNC_VIEWS_ENABLED = bool(os.getenv("ASYNC_VIEWS_ENABLED"))
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 
 
@@ -1,6 +1,8 @@
 from celery.schedules import crontab
 from pendulum import Duration
 
+from .sites import TRAFFIC_BUFFER_FLUSH_INTERVAL
+
 # 定时任务相关
 task_schedule = {
     "apps.sspanel.tasks.auto_reset_free_user_traffic_task": crontab(
@@ -12,7 +14,11 @@ task_schedule = {
     "apps.sspanel.tasks.make_up_lost_order_task": Duration(seconds=15),
     "apps.sspanel.tasks.check_user_state_task": Duration(minutes=1),
     "apps.sspanel.tasks.clean_traffic_log_task": Duration(minutes=1),
+    "apps.sspanel.tasks.rollup_traffic_task": Duration(minutes=1),
     "apps.sspanel.tasks.close_stale_tickets_task": Duration(minutes=1),
+    "apps.sspanel.tasks.flush_traffic_buffer_task": Duration(
+        seconds=TRAFFIC_BUFFER_FLUSH_INTERVAL
+    ),
     # stats
     "apps.stats.tasks.gen_daily_stats_task": Duration(minutes=10),
 }
@@ -3,3 +3,9 @@ import os
 REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
 REDIS_DB_URI = os.getenv("REDIS_DB_URI", "redis://" + REDIS_HOST + ":6379/0")
 REDIS_CACHE_URI = os.getenv("REDIS_CACHE_URI", "redis://" + REDIS_HOST + ":6379/1")
+# 进程内 LRU 缓存最多保存的 key 数量，0 表示不开启
+CACHE_LOCAL_MAXSIZE = int(os.getenv("CACHE_LOCAL_MAXSIZE", 0))
+# 缓存默认的序列化方式 json/msgpack，pickle 只在代码里显式指定的地方使用
+CACHE_SERIALIZER = os.getenv("CACHE_SERIALIZER", "json")
+# 缓存的值超过这个大小(字节)就压缩，0 表示不压缩
+CACHE_COMPRESS_THRESHOLD = int(os.getenv("CACHE_COMPRESS_THRESHOLD", 1024 * 8))
@@ -55,6 +55,19 @@ TOKEN = os.getenv("TOKEN", "youowntoken")
 # 是否开启用户到期邮件通知
 EXPIRE_EMAIL_NOTICE = bool(os.getenv("EXPIRE_EMAIL_NOTICE", False))
 
+# 节点上报的流量先累加到 redis 里，再由定时任务批量写入数据库
+TRAFFIC_BUFFER_ENABLED = bool(os.getenv("TRAFFIC_BUFFER_ENABLED"))
+# 批量写入的间隔(秒)
+TRAFFIC_BUFFER_FLUSH_INTERVAL = int(os.getenv("TRAFFIC_BUFFER_FLUSH_INTERVAL", 10))
+# 原始流量记录保留的天数
+TRAFFIC_LOG_RETENTION_DAYS = int(os.getenv("TRAFFIC_LOG_RETENTION_DAYS", 7))
+# 流量小时汇总保留的天数，每日汇总一直保留
+TRAFFIC_HOURLY_ROLLUP_RETENTION_DAYS = int(
+    os.getenv("TRAFFIC_HOURLY_ROLLUP_RETENTION_DAYS", 31)
+)
+# 节点拉配置时最多挂起等待配置变动的时间(秒)，只在 ASGI 下生效
+CONFIG_LONG_POLL_TIMEOUT = int(os.getenv("CONFIG_LONG_POLL_TIMEOUT", 30))
+
 # SHORT_URL_ALPHABET 请随机生成,且不要重复
 DEFAULT_ALPHABET = os.getenv("DEFAULT_ALPHABET", "qwertyuiopasdfghjklzxcvbnm")
 